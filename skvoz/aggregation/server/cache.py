@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Caches of the aggregator: the LRU cache used for the parsed queries and
+the partial results of the queries, and the ResultCache that keeps the
+aggregate states computed on the immutable (consolidated) segments.
+
+    cache = ResultCache(64 << 20)
+    results = cache.execute(context, source_name, source, keys)
+    if results is None:
+        # Query not cacheable
+"""
+
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from collections import OrderedDict
+
+from skvoz.aggregation.server import parallel
+
+import threading
+
+class LRUCache(object):
+    """
+    Thread-safe cache that keeps at most max_items entries, or entries
+    for a total of max_size (as computed by sizeof), evicting the least
+    recently used ones. on_evict, if specified, is called with the
+    (key, value) of each evicted entry.
+    """
+    def __init__(self, max_items=None, max_size=None, sizeof=len, on_evict=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+        self.size = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value
+            return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.data.pop(key, default)
+            if value is not default and self.max_size is not None:
+                self.size -= self.sizeof(value)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_size is not None else 0
+        if self.max_size is not None and size > self.max_size:
+            return
+
+        evicted = []
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None and self.max_size is not None:
+                self.size -= self.sizeof(old)
+            self.data[key] = value
+            self.size += size
+
+            data = self.data
+            while self.max_items is not None and len(data) > self.max_items:
+                evicted.append(self._evict())
+            while self.max_size is not None and self.size > self.max_size:
+                evicted.append(self._evict())
+
+        # Outside the lock, the callback may be slow
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def _evict(self):
+        key, value = self.data.popitem(last=False)
+        if self.max_size is not None:
+            self.size -= self.sizeof(value)
+        return key, value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+class ResultCache(object):
+    """
+    Cache of the aggregate states of the mergeable queries, one entry for
+    each (query, segment). The consolidated segments never change, so
+    their entries are never invalidated: only the files that may still
+    change (e.g. latest) are aggregated again on every execution, and the
+    states are merged with the cached ones.
+    """
+    DEFAULT_SIZE = 64 << 20
+
+    def __init__(self, max_size=DEFAULT_SIZE):
+        self.states = LRUCache(max_size=max_size)
+
+    def clear(self):
+        self.states.clear()
+
+    def execute(self, context, source_name, source, keys, executor=None):
+        """
+        Returns the list of (groups, results) of the query,
+        or None if the query results can't be cached.
+        executor, if specified, is used to aggregate the missing segments.
+        """
+        if context.plan_key is None or not parallel.is_parallelizable(context):
+            return None
+
+        partials = []
+        missing = []
+        for key, files in source.files_from_keys(keys):
+            if context.time_period:
+                files = source.filter_files_by_time(files, *context.time_period)
+            for f in files:
+                ckey = source.cache_key(f, context.time_period)
+                if ckey is not None:
+                    ckey = (context.plan_key, source_name, key, ckey)
+                    states = self.states.get(ckey)
+                    if states is not None:
+                        partials.append(loads(states))
+                        continue
+                missing.append((ckey, (context, source, key, (f,))))
+
+        if executor is not None and len(missing) > 1:
+            computed = executor.map(p for _, p in missing)
+        else:
+            computed = (parallel.aggregate_partition(p) for _, p in missing)
+
+        for (ckey, _), states in zip(missing, computed):
+            # Store a copy, the merge modifies the states
+            if ckey is not None:
+                self.states.put(ckey, dumps(states, HIGHEST_PROTOCOL))
+            partials.append(states)
+
+        return parallel.merge_states(context, partials)
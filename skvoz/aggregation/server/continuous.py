@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Continuous queries, for the live dashboards.
+
+A continuous query is registered once: the existing rows are aggregated
+and the state of every group is kept in memory. Each snapshot() or
+delta() call folds in only the rows appended to the files since the
+previous call, so the refresh cost follows the rate of new data
+instead of the size of the TIME window.
+
+    cquery = ContinuousQuery(context, source, keys)
+    version, results = cquery.snapshot()
+    ...
+    version, changed = cquery.delta(version)
+"""
+
+from skvoz.aggregation.server import pipeline
+from skvoz.aggregation.util import timestamps
+
+import threading
+
+class ContinuousQuery(object):
+    def __init__(self, context, source, keys):
+        if context.store is None:
+            raise Exception("Continuous queries need a STORE statement!")
+        if context.order_by is not None or context.limit is not None:
+            raise Exception("Continuous queries don't support ORDER BY and LIMIT!")
+
+        group_keys = list(context.group_keys or [])
+        if context.stmt_time is not None and context.stmt_time.is_relative():
+            if '__ts__' not in group_keys:
+                raise Exception("Continuous queries with a relative TIME need a time GROUP BY!")
+
+        self.context = context
+        self.source = source
+        self.keys = keys
+        self.group_keys = group_keys
+
+        self.version = 0
+        self.groups = {}
+        self.tails = {}
+        self.segments = set()
+        self.lock = threading.Lock()
+
+        # Aggregate the immutable segments, the tails are read on update()
+        context = context.resolve_time()
+        for key, files in self._files(context):
+            segments = []
+            for f in files:
+                tail = self.source.open_tail(f)
+                if tail is None:
+                    self.segments.add(f)
+                    segments.append(f)
+                else:
+                    self.tails[f] = (key, tail)
+            if segments:
+                rows = pipeline.key_stream(context, source, key, segments)
+                self._apply(rows)
+        self._update(context)
+
+    def close(self):
+        with self.lock:
+            for _, tail in self.tails.itervalues():
+                tail.close()
+            self.tails.clear()
+            self.groups.clear()
+
+    def snapshot(self):
+        """
+        Returns the current (version, [(groups, results), ...]) of the query.
+        """
+        with self.lock:
+            self._update(self.context.resolve_time())
+            return self.version, self._results(self.groups)
+
+    def delta(self, since):
+        """
+        Returns the current version and the (groups, results) of the groups
+        changed after the 'since' version. The groups that leave a relative
+        TIME window are not reported, the client drops them.
+        """
+        with self.lock:
+            self._update(self.context.resolve_time())
+            changed = dict((gkey, group) for gkey, group in self.groups.iteritems()
+                                         if group[1] > since)
+            if not changed:
+                return self.version, []
+            return self.version, self._results(changed)
+
+    def _files(self, context):
+        for key, files in self.source.files_from_keys(self.keys):
+            if context.time_period:
+                files = self.source.filter_files_by_time(files, *context.time_period)
+            yield key, files
+
+    def _update(self, context):
+        self.version += 1
+
+        # Segments consolidated after the registration hold the rows
+        # already read from the tail of 'latest', as the files in
+        # consolidation (the old 'latest' renamed). New files are tailed.
+        inodes = set()
+        for _, tail in self.tails.itervalues():
+            inodes |= tail.inodes
+
+        for key, files in self._files(context):
+            for f in files:
+                if f not in self.segments and f not in self.tails:
+                    tail = self.source.open_tail(f)
+                    if tail is None or tail.inode() in inodes:
+                        self.segments.add(f)
+                    else:
+                        self.tails[f] = (key, tail)
+
+        for key, tail in self.tails.itervalues():
+            rows = tail.read()
+            if rows:
+                self._apply(self._stream(context, key, rows))
+
+        if context.time_period and context.stmt_time.is_relative():
+            self._expire(context.time_period[0])
+
+    def _stream(self, context, key, rows):
+        """
+        Build the operators of the appended rows, the same of key_stream().
+        """
+        stream = ((ts, key, data) for ts, data in rows)
+        if context.time_period:
+            stream = timestamps.filter_by_interval(stream, *context.time_period)
+        stream = pipeline.SplitOperator(stream, context)
+        if context.group_period:
+            stream = pipeline.TimeBucketOperator(stream, context.group_period, context.group_width)
+        return stream
+
+    def _apply(self, rows):
+        keys = self.group_keys
+        new_functions = self.context.new_functions
+        groups = self.groups
+        version = self.version
+
+        for ts, key, items in rows:
+            items['__ts__'] = ts
+            items['__key__'] = key
+            gkey = tuple((k, items[k]) for k in keys)
+            group = groups.get(gkey)
+            if group is None:
+                group = groups[gkey] = [pipeline.AggregateState(new_functions(), keys), version]
+            else:
+                group[1] = version
+            group[0].apply(items)
+
+    def _expire(self, start):
+        """
+        Drop the groups of the time periods before the one of start.
+        The first period kept may still hold rows older than start.
+        """
+        bucket = timestamps.TimeBucket(self.context.group_period, self.context.group_width)
+        first_key, _, _ = bucket.range(timestamps.date_to_epoch(start))
+
+        index = self.group_keys.index('__ts__')
+        for gkey in self.groups.keys():
+            if gkey[index][1] < first_key:
+                del self.groups[gkey]
+
+    def _results(self, groups):
+        if not self.group_keys:
+            group = groups.get(())
+            if group is None:
+                return [(None, [])]
+            return [(None, group[0].results())]
+        return [(dict(gkey), groups[gkey][0].results()) for gkey in sorted(groups)]
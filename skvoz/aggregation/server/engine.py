@@ -25,56 +25,57 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from heapq import merge
-
-from skvoz.aggregation.server import table
+from skvoz.aggregation.server.cache import LRUCache, ResultCache
+from skvoz.aggregation.server import continuous
+from skvoz.aggregation.server import parallel
+from skvoz.aggregation.server import pipeline
+from skvoz.aggregation.server import pushdown
+from skvoz.aggregation.server import vector
 from skvoz.aggregation.util import timestamps
 from skvoz.aggregation import tdql
 from skvoz.util.data import DataSplitter
 
-def _filter_bypass(tsdata):
-    return tsdata
+from uuid import uuid1
+from copy import copy
 
-def _group_bypass(tsdata):
-    for ts, data in tsdata:
-        yield ts, ((ts, data),)
+import re
 
 class AggregationContext(object):
     def __init__(self):
         self.data_split = None
         self.time_period = None
         self.group_period = None
+        self.group_width = 1
         self.group_keys = None
         self.data_filters = []
-        self.functions = {}
-
-    def functions_reset(self):
-        for _, func in self.functions.iteritems():
-            func.reset()
-
-    def functions_apply(self, items):
-        for func in self.functions.itervalues():
-            func.apply(items)
-
-    def functions_results(self):
-        results = {}
-        for key, func in self.functions.iteritems():
-            results[key] = func.result()
-        return results
-
-    def aggregate_results(self, rows, groups=None):
-        print 'AGGREGATE'
-        if self.functions:
-            print 'STEP 1'
-            self.functions_reset()
-            print 'STEP 2'
-            for items in rows:
-                if groups: 
-                    print 'GROUPS', groups
-                    items.update(groups)
-                self.functions_apply(items)
-            return [self.functions_results()]
-        return list(rows)
+        self.scan_filter = None
+        self.store = None
+        self.row_time = False
+        self.order_by = None
+        self.order_desc = False
+        self.limit = None
+        self.stmt_time = None
+        self.plan_key = None
+
+    def new_functions(self):
+        """
+        Returns a fresh set of STORE functions, one for each group,
+        or None if the query has nothing to compute.
+        """
+        if self.store is None:
+            return None
+        return dict(self.store.functions())
+
+    def resolve_time(self):
+        """
+        Returns the context with the relative time period (e.g. TIME 5 hours)
+        computed again, or the context itself if the period is fixed.
+        """
+        if self.stmt_time is None or not self.stmt_time.is_relative():
+            return self
+        context = copy(self)
+        context.time_period = (self.stmt_time.start, self.stmt_time.end)
+        return context
 
     def filter_row(self, items):
         for func in self.data_filters:
@@ -82,81 +83,86 @@ class AggregationContext(object):
                 return True
         return False
 
+def _close_continuous(qid, cquery):
+    cquery.close()
+
 class AggregatorEngine(object):
     """
     for key, data in engine.fetch(context, source, keys):
         for ts, value in data:
             ...
     """
-    def __init__(self):
+    CONTINUOUS_QUERIES = 64
+
+    def __init__(self, workers=None, cache_size=None):
         self.sources = {}
+        self.continuous = LRUCache(self.CONTINUOUS_QUERIES, on_evict=_close_continuous)
+        if workers > 1:
+            self.parallel = parallel.ParallelExecutor(workers)
+        else:
+            self.parallel = None
+        if cache_size:
+            self.cache = ResultCache(cache_size)
+        else:
+            self.cache = None
+
+    def close(self):
+        if self.parallel is not None:
+            self.parallel.close()
+            self.parallel = None
 
     def add_source(self, name, source):
         self.sources[name] = source
 
-    def fetch(self, context, source_name, keys, group_by_key=False):
+    def register(self, context, source_name, keys):
+        """
+        Register a continuous query, returning its id.
+        """
         source = self.sources.get(source_name)
         if source is None:
             raise Exception("Invalid Source '%s'!" % source_name)
-        
-        data = []
-        groups = []
-        for group, files in source.files_from_keys(keys):
-            groups.append(group)
-            data.append(self.fetch_files(context, source, group, files))
-
-        if context.data_split is None:
-            dtb = self._merge_raw(context, data)
-        else:
-            dtb = self._merge_splits(context, data)
 
-        if context.group_keys:
-            results = table.group_by(dtb, context.group_keys)
-            return [(k, context.aggregate_results(r, k)) for k, r in results]
+        qid = uuid1().hex
+        self.continuous.put(qid, continuous.ContinuousQuery(context, source, keys))
+        return qid
 
-        return [(None, context.aggregate_results(dtb))]
+    def continuous_query(self, qid):
+        return self.continuous.get(qid)
 
-    def _merge_raw(self, context, data):
-        columns = ['__ts__', '__key__', 'data']
+    def unregister(self, qid):
+        cquery = self.continuous.pop(qid)
+        if cquery is None:
+            return False
+        cquery.close()
+        return True
 
-        dtb = table.Table('foo', columns)
-        for ts, key, value in merge(*data):
-            dtb.insert({'__ts__': ts, '__key__': key, 'data': value})
+    def fetch(self, context, source_name, keys, group_by_key=False):
+        source = self.sources.get(source_name)
+        if source is None:
+            raise Exception("Invalid Source '%s'!" % source_name)
 
-        return dtb
+        results = self._execute(context, source_name, source, keys)
+        return pipeline.order_limit(context, results)
 
-    def _merge_splits(self, context, data):
-        columns = ['__ts__', '__key__'] + context.data_split.varnames
+    def _execute(self, context, source_name, source, keys):
+        vplan = vector.plan(context)
+        if vplan is not None:
+            try:
+                return vplan.execute(source, keys)
+            except vector.NotVectorizable:
+                pass
 
-        dtb = table.Table('foo', columns)
-        for ts, key, items in merge(*data):
-            items.update({'__ts__': ts, '__key__': key})
-            dtb.insert(items)
+        if self.cache is not None:
+            results = self.cache.execute(context, source_name, source, keys, self.parallel)
+            if results is not None:
+                return results
 
-        return dtb
+        if self.parallel is not None and parallel.is_parallelizable(context):
+            results = self.parallel.execute(context, source, keys)
+            if results is not None:
+                return results
 
-    def fetch_files(self, context, source, group, files):
-        # Initialize Time Period Filter
-        if context.time_period:
-            files = source.filter_files_by_time(files, *context.time_period)
-            ff = lambda ts, p=context.time_period: timestamps.filter_by_interval(ts, *p)
-        else:
-            ff = _filter_bypass
-
-        # Initialize Group Period Filter
-        gf = context.group_period or _group_bypass
-
-        # Read Data with Filters
-        for ts, values in gf(ff(source.read_files(files))):
-            if context.data_split:
-                for _, v in values:
-                    items = context.data_split(v)
-                    if context.filter_row(items): 
-                        continue
-                    yield ts, group, items
-            else:
-                for _, v in values:
-                    yield ts, group, v
+        return pipeline.build(context, source, keys)
 
 # From {files: ['a', 'b', 'c']}
 # Time Intervals [datetime.datetime(2012, 1, 1, 0, 0)]
@@ -167,7 +173,38 @@ def execute_query(engine, query):
     context, source, keys = parse_query(query)
     return engine.fetch(context, source, keys)
 
+def register_query(engine, query):
+    context, source, keys = parse_query(query)
+    return engine.register(context, source, keys)
+
+# Parsed queries, by normalized query text
+PLAN_CACHE_SIZE = 256
+_plan_cache = LRUCache(PLAN_CACHE_SIZE)
+
+RX_QUERY_SPACES = re.compile(r"""('(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")|\s+""")
+
+def normalize_query(query):
+    """
+    Collapse the spaces outside the quoted strings.
+    """
+    return RX_QUERY_SPACES.sub(lambda m: m.group(1) or ' ', query).strip()
+
 def parse_query(query):
+    """
+    Returns the (context, source, keys) of the query. The parsed queries are
+    cached, only the relative time periods are computed again.
+    """
+    key = normalize_query(query)
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = _parse_query(query)
+        plan[0].plan_key = key
+        _plan_cache.put(key, plan)
+
+    context, source, keys = plan
+    return context.resolve_time(), source, keys
+
+def _parse_query(query):
     # Parse the user query
     query = tdql.parse(query)
 
@@ -176,30 +213,33 @@ def parse_query(query):
 
     # Data Split Options
     if query.stmt_split is not None:
-        context.data_split = DataSplitter(query.stmt_split.results, query.stmt_split.delimiters)
+        context.data_split = DataSplitter(query.stmt_split.results, query.stmt_split.delimiters,
+                                          query.stmt_split.types)
 
     # Data Filter
     if query.stmt_where is not None:
         context.data_filters.append(query.stmt_where.evaluator())
+        context.scan_filter = pushdown.plan(context.data_split, query.stmt_where.clauses)
 
     # Data Store Options
     if query.stmt_store is not None:
-        for key, func in query.stmt_store.functions():
-            context.functions[key] = func
+        context.store = query.stmt_store
+        context.row_time = query.stmt_store.uses_window()
 
     # Extract filtering functions
     if query.stmt_time is not None:
         if query.stmt_time.start is not None:
             context.time_period = (query.stmt_time.start, query.stmt_time.end)
+            context.stmt_time = query.stmt_time
 
     # Extract grouping functions
     if query.stmt_group is not None:
         if query.stmt_group.time_period is not None:
-            func_name = 'group_by_' + query.stmt_group.time_period
-            func = getattr(timestamps, func_name)
-            if func is None:
-                raise Exception("Invalid grouping function '%s'!" % func_name)
-            context.group_period = func
+            period = query.stmt_group.time_period
+            if period not in timestamps.TimeBucket.FORMATS:
+                raise Exception("Invalid grouping period '%s'!" % period)
+            context.group_period = period
+            context.group_width = query.stmt_group.time_width
 
         if query.stmt_group.keys:
             splits = set(('__ts__', '__key__'))
@@ -210,4 +250,11 @@ def parse_query(query):
 
             context.group_keys = query.stmt_group.keys
 
+    # Order and limit the groups
+    if query.stmt_order is not None:
+        context.order_by = query.order_by()
+        context.order_desc = query.stmt_order.descending
+    if query.stmt_limit is not None:
+        context.limit = query.stmt_limit.count
+
     return context, query.stmt_from.source, query.stmt_from.keys
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Parallel execution of the aggregation queries.
+
+The files of each key are split in partitions, one for each segment,
+and a pool of worker processes computes the partial aggregate states of
+every partition. The partial states of the same group are then merged,
+so only queries with mergeable STORE functions can run in parallel.
+
+    executor = ParallelExecutor(workers=4)
+    results = executor.execute(context, source, keys)
+    if results is None:
+        # Not worth (or not possible) running in parallel
+"""
+
+from multiprocessing import Pool
+
+from skvoz.aggregation.server import pipeline
+
+def aggregate_partition(partition):
+    """
+    Returns the list of (group key, state) of a (context, source, key, files)
+    partition.
+    """
+    context, source, key, files = partition
+    group_keys = list(context.group_keys or [])
+    stream = pipeline.key_stream(context, source, key, files)
+    if pipeline.is_ordered(group_keys):
+        aggregate = pipeline.AggregateOperator(stream, context, group_keys)
+    else:
+        aggregate = pipeline.HashAggregateOperator(stream, context, group_keys)
+    return list(aggregate.states())
+
+def is_parallelizable(context):
+    if context.store is None:
+        return False
+    return all(f.is_mergeable() for f in context.new_functions().itervalues())
+
+def merge_states(context, partials):
+    """
+    Merge the lists of (group key, state) of the partitions,
+    returning the list of (groups, results) of the query.
+    """
+    groups = {}
+    for states in partials:
+        for gkey, state in states:
+            current = groups.get(gkey)
+            if current is None:
+                groups[gkey] = state
+            else:
+                current.merge(state)
+
+    if not context.group_keys:
+        if not groups:
+            return [(None, [])]
+        return [(None, groups[()].results())]
+
+    return [(dict(gkey), groups[gkey].results()) for gkey in sorted(groups)]
+
+class ParallelExecutor(object):
+    def __init__(self, workers):
+        self.pool = Pool(workers)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def map(self, partitions):
+        """
+        Returns the list of (group key, state) of each partition, in order.
+        """
+        return self.pool.imap(aggregate_partition, partitions)
+
+    def partitions(self, context, source, keys):
+        for key, files in source.files_from_keys(keys):
+            if context.time_period:
+                files = source.filter_files_by_time(files, *context.time_period)
+            for f in files:
+                yield context, source, key, (f,)
+
+    def execute(self, context, source, keys):
+        """
+        Returns the list of (groups, results) of the query,
+        or None if there's only one partition to process.
+        """
+        partitions = list(self.partitions(context, source, keys))
+        if len(partitions) < 2:
+            return None
+
+        partials = self.pool.imap_unordered(aggregate_partition, partitions)
+        return merge_states(context, partials)
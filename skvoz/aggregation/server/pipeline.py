@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Pull-based operators used by the AggregatorEngine to execute a query.
+
+    scan -> filter -> split -> bucket -> merge -> group/aggregate -> emit
+
+Every operator is an iterable that pulls (ts, key, items) rows from its
+child, so nothing is read until the consumer asks for the next result.
+"""
+
+from itertools import chain, islice
+from heapq import merge, nlargest, nsmallest
+
+from skvoz.aggregation.util import timestamps
+
+class Operator(object):
+    def __init__(self, child):
+        self.child = child
+
+    def __iter__(self):
+        return iter(self.child)
+
+class ScanOperator(Operator):
+    """
+    Read the files of a key, yielding (ts, key, data) ordered by timestamp.
+    The (start, end) time period is pushed down to the source, that seeks
+    to the first row of the range and stops at the end, and block_filter
+    skips the blocks that can't match the query.
+    """
+    def __init__(self, source, key, files, time_period=None, block_filter=None):
+        self.source = source
+        self.files = files
+        self.key = key
+        self.time_period = time_period
+        self.block_filter = block_filter
+
+    def __iter__(self):
+        key = self.key
+        for ts, data in self.source.read_files(self.files, self.time_period, self.block_filter):
+            yield ts, key, data
+
+class TimeBucketOperator(Operator):
+    """
+    Replace the row timestamp with the time period key (e.g. the hour).
+    """
+    def __init__(self, child, period, width=1):
+        self.child = child
+        self.period = period
+        self.width = width
+
+    def __iter__(self):
+        bucket = timestamps.TimeBucket(self.period, self.width)
+        for ts, key, data in self.child:
+            yield bucket(ts), key, data
+
+class SplitOperator(Operator):
+    """
+    Turn the raw data in a dict of items, using the context data splitter
+    and dropping the rows rejected by the scan filter (before the split)
+    and by the context filters. The window functions (context.row_time)
+    get the row timestamp as '__time__'.
+    """
+    def __init__(self, child, context):
+        self.child = child
+        self.context = context
+
+    def __iter__(self):
+        data_split = self.context.data_split
+        if self.context.row_time:
+            return self._with_time(data_split)
+        return self._split(data_split)
+
+    def _with_time(self, data_split):
+        for ts, key, items in self._split(data_split):
+            items['__time__'] = ts
+            yield ts, key, items
+
+    def _split(self, data_split):
+        if data_split is None:
+            for ts, key, data in self.child:
+                yield ts, key, {'data': data}
+        else:
+            filter_row = self.context.filter_row
+            scan_filter = self.context.scan_filter
+            split_row = scan_filter.split_row if scan_filter is not None else data_split
+            for ts, key, data in self.child:
+                items = split_row(data)
+                if items is None or filter_row(items):
+                    continue
+                yield ts, key, items
+
+class MergeOperator(Operator):
+    """
+    Merge the ordered children in a single ordered stream.
+    """
+    def __init__(self, children):
+        self.children = children
+
+    def __iter__(self):
+        return merge(*self.children)
+
+class AggregateState(object):
+    """
+    The state of a single group: the STORE functions to apply or,
+    if nothing has to be computed, the list of rows without the group keys.
+    """
+    def __init__(self, functions, keys):
+        self.functions = functions
+        self.keys = keys
+        self.rows = []
+
+    def apply(self, items):
+        if self.functions is None:
+            for k in self.keys:
+                del items[k]
+            self.rows.append(items)
+        else:
+            for func in self.functions.itervalues():
+                func.apply(items)
+
+    def results(self):
+        if self.functions is None:
+            return self.rows
+        return [dict((k, f.result()) for k, f in self.functions.iteritems())]
+
+    def merge(self, other):
+        """
+        Merge the state of the same group computed on other rows.
+        """
+        if self.functions is None:
+            self.rows.extend(other.rows)
+        else:
+            for name, func in self.functions.iteritems():
+                func.merge(other.functions[name])
+
+class AggregateOperator(Operator):
+    """
+    Aggregate a stream where the rows of the same group are contiguous.
+    Only the state of the current group is kept in memory, and the group
+    result is emitted as soon as the next group starts.
+    """
+    def __init__(self, child, context, keys):
+        self.child = child
+        self.context = context
+        self.keys = keys
+
+    def __iter__(self):
+        states = self.states()
+        if not self.keys:
+            for _, state in states:
+                yield None, state.results()
+                break
+            else:
+                yield None, []
+        else:
+            for gkey, state in states:
+                yield dict(gkey), state.results()
+
+    def states(self):
+        """
+        Returns the (group key, state) of each group, where the group key
+        is a tuple of (name, value) ordered as the context group keys.
+        """
+        keys = self.keys
+        context = self.context
+
+        current = None
+        state = None
+        for ts, key, items in self.child:
+            items['__ts__'] = ts
+            items['__key__'] = key
+            gkey = tuple((k, items[k]) for k in keys)
+            if state is None or gkey != current:
+                if state is not None:
+                    yield current, state
+                current = gkey
+                state = AggregateState(context.new_functions(), keys)
+            state.apply(items)
+
+        if state is not None:
+            yield current, state
+
+class HashAggregateOperator(AggregateOperator):
+    """
+    Aggregate a stream grouping on arbitrary keys, the state of each group
+    is kept in a hash table and updated as the rows stream past.
+    """
+    def states(self):
+        keys = self.keys
+        new_functions = self.context.new_functions
+
+        groups = {}
+        for ts, key, items in self.child:
+            items['__ts__'] = ts
+            items['__key__'] = key
+            gkey = tuple((k, items[k]) for k in keys)
+            state = groups.get(gkey)
+            if state is None:
+                state = groups[gkey] = AggregateState(new_functions(), keys)
+            state.apply(items)
+
+        for gkey in sorted(groups):
+            yield gkey, groups[gkey]
+
+def is_ordered(keys):
+    """
+    Returns True if the rows of a single key stream with the same group
+    keys are contiguous.
+    """
+    return set(keys) <= set(['__ts__', '__key__'])
+
+def _is_key_ordered(keys):
+    return keys[:1] == ['__key__'] and set(keys[1:]) <= set(['__ts__'])
+
+def _is_time_ordered(keys):
+    return keys in ([], ['__ts__'], ['__ts__', '__key__'])
+
+def key_stream(context, source, key, files):
+    """
+    Build the operators that read the specified files of a key, returning
+    the (ts, key, items) rows ordered by time.
+    """
+    block_filter = None
+    if context.scan_filter is not None:
+        block_filter = context.scan_filter.skip_block
+    op = ScanOperator(source, key, files, context.time_period, block_filter)
+    op = SplitOperator(op, context)
+    if context.group_period:
+        op = TimeBucketOperator(op, context.group_period, context.group_width)
+    return op
+
+def build(context, source, keys):
+    """
+    Build the operators tree for the specified context, returning an
+    iterable of (groups, results):
+        for groups, results in build(context, source, keys):
+            ...
+    """
+    streams = []
+    for key, files in source.files_from_keys(keys):
+        if context.time_period:
+            files = source.filter_files_by_time(files, *context.time_period)
+        streams.append((key, key_stream(context, source, key, files)))
+
+    group_keys = list(context.group_keys or [])
+
+    # Each key stream is already time ordered, aggregate them one by one.
+    if _is_key_ordered(group_keys):
+        streams.sort(key=lambda stream: stream[0])
+        return chain(*[AggregateOperator(op, context, group_keys) for _, op in streams])
+
+    stream = MergeOperator([op for _, op in streams])
+    if _is_time_ordered(group_keys):
+        return AggregateOperator(stream, context, group_keys)
+    return HashAggregateOperator(stream, context, group_keys)
+
+def order_limit(context, results):
+    """
+    Apply the ORDER BY and LIMIT of the context to the (groups, results)
+    of a query. The groups are emitted ordered by the group keys, so when
+    ordering on the first group key only the first 'limit' groups are read
+    (and the scan stops there), otherwise a heap keeps the best groups.
+    """
+    limit = context.limit
+    if context.order_by is None:
+        return results if limit is None else islice(results, limit)
+
+    kind, name = context.order_by
+    if kind == 'group':
+        if not context.order_desc and context.group_keys[0] == name:
+            return results if limit is None else islice(results, limit)
+        sort_key = lambda (groups, values): groups[name]
+    else:
+        sort_key = lambda (groups, values): values[0][name] if values else None
+
+    if limit is None:
+        return sorted(results, key=sort_key, reverse=context.order_desc)
+    select = nlargest if context.order_desc else nsmallest
+    return select(limit, results, key=sort_key)
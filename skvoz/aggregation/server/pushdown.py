@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Push the simple WHERE predicates down to the storage scan.
+
+The conjuncts of the WHERE clause in the form 'column <op> constant'
+are used to skip the rows before splitting them into dicts and, for the
+default space split, to skip whole blocks using their min/max statistics.
+The pushed predicates are only a necessary condition, the complete WHERE
+filter is still applied to the rows that pass the scan.
+
+    scan = pushdown.plan(context.data_split, query.stmt_where.clauses)
+    items = scan.split_row(data)
+    if items is not None:
+        ...
+"""
+
+from skvoz.aggregation.tdql.tokenizer import *
+
+import operator
+
+_COMPARISONS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+_SWAPPED_COMPARISONS = {
+    '<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==', '!=': '!=',
+}
+
+def _expr_tree(rpn):
+    """
+    Convert the rpn tokens in a tree of ('op', operator, left, right)
+    and ('leaf', token, symbol), returns None if the expression
+    contains functions or unary operators.
+    """
+    stack = []
+    for token, symbol in rpn:
+        if token == TOKEN_OPERATOR:
+            if len(stack) < 2:
+                return None
+            right = stack.pop()
+            left = stack.pop()
+            stack.append(('op', symbol, left, right))
+        elif token in (TOKEN_STRING, TOKEN_NUMBER, TOKEN_BOOLEAN, TOKEN_KEYWORD):
+            stack.append(('leaf', token, symbol))
+        else:
+            return None
+    return stack[0] if len(stack) == 1 else None
+
+def _is_const(tree):
+    if tree[0] != 'leaf':
+        return False
+    if tree[1] == TOKEN_STRING:
+        return True
+    return tree[1] == TOKEN_NUMBER and not isinstance(tree[2], bool)
+
+def _conjuncts(tree):
+    """
+    Returns the (column, operator, constant) predicates
+    that must all be true for the tree to be true.
+    """
+    if tree[0] != 'op':
+        return []
+
+    _, symbol, left, right = tree
+    if symbol == 'AND':
+        return _conjuncts(left) + _conjuncts(right)
+
+    if symbol not in _COMPARISONS:
+        return []
+
+    if left[0] == 'leaf' and left[1] == TOKEN_KEYWORD and _is_const(right):
+        return [(left[2], symbol, right[2])]
+    if right[0] == 'leaf' and right[1] == TOKEN_KEYWORD and _is_const(left):
+        return [(right[2], _SWAPPED_COMPARISONS[symbol], left[2])]
+    return []
+
+def _block_skip(symbol, value, vmin, vmax):
+    """
+    Returns True if no value in the [vmin, vmax] range
+    can satisfy 'x <symbol> value'.
+    """
+    if symbol == '<': return vmin >= value
+    if symbol == '<=': return vmin > value
+    if symbol == '>': return vmax <= value
+    if symbol == '>=': return vmax < value
+    if symbol == '==': return value < vmin or value > vmax
+    return False
+
+class ScanFilter(object):
+    """
+    The predicates pushed down to the scan of a query.
+    """
+    def __init__(self, data_split, predicates):
+        self.data_split = data_split
+        self.nvars = len(data_split.varnames)
+
+        index = dict((name, i) for i, name in enumerate(data_split.varnames))
+        self.predicates = [(index[name], symbol, value) for name, symbol, value in predicates]
+        self._convert = None
+
+        # Strings compared for equality must be in the raw data
+        self.substrings = [value for _, symbol, value in self.predicates
+                                 if symbol == '==' and isinstance(value, basestring)]
+
+        # Block statistics are computed on the space separated fields,
+        # as numbers (the vars declared as strings are never numbers)
+        self.numeric = []
+        if data_split.delimiters is None:
+            self.numeric = [(i, symbol, value) for i, symbol, value in self.predicates
+                                               if not isinstance(value, basestring) and
+                                                  data_split.types[i] != 'str']
+
+    def split_row(self, data):
+        """
+        Returns the dict of the split data, as DataSplitter does, or None
+        if the raw data can't match the WHERE filter. The fields of the
+        predicates are converted once, and used for both.
+        """
+        for value in self.substrings:
+            if value not in data:
+                return None
+
+        data_split = self.data_split
+        splits = data_split.split(data)
+        if len(splits) != self.nvars:
+            # Let the splitter report the error
+            return data_split(data)
+
+        convert = self._convert
+        if convert is None:
+            convert = self._convert = data_split.compile_filter(splits, self.predicates)
+        try:
+            return convert(splits)
+        except ValueError:
+            # Let the splitter report the error
+            return data_split(data)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_convert'] = None
+        return state
+
+    def skip_block(self, stats):
+        """
+        Returns True if no row of the block (tsfile.BlockStats) can
+        match the WHERE filter.
+        """
+        if not self.numeric:
+            return False
+
+        # Rows with a different number of fields are split differently
+        nvars = self.nvars
+        if stats.nfields_min < nvars:
+            return False
+
+        for i, symbol, value in self.numeric:
+            if i == nvars - 1 and stats.nfields_max != nvars:
+                continue
+            field = stats.field(i)
+            if field is not None and _block_skip(symbol, value, field[0], field[1]):
+                return True
+        return False
+
+def plan(data_split, where_rpn):
+    """
+    Returns the ScanFilter of the WHERE clause,
+    or None if there's nothing to push down.
+    """
+    if data_split is None or not where_rpn:
+        return None
+
+    tree = _expr_tree(where_rpn)
+    if tree is None:
+        return None
+
+    varnames = set(data_split.varnames)
+    predicates = [p for p in _conjuncts(tree) if p[0] in varnames]
+    if not predicates:
+        return None
+    return ScanFilter(data_split, predicates)
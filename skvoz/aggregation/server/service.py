@@ -32,6 +32,7 @@ from skvoz.aggregation.server import sources
 from skvoz.aggregation.server import engine
 
 from skvoz.util.http import HttpRequestHandler, UnixHttpServer, TcpHttpServer
+from skvoz.util.data import DataTable, COLUMNS_MIME, flatten_result
 from skvoz.util.service import AbstractService
 
 class AggregatorRequestHandler(HttpRequestHandler):
@@ -40,28 +41,99 @@ class AggregatorRequestHandler(HttpRequestHandler):
         request = dict(self._post_data())
         query = b64decode(request['query'])
 
-        self.send_headers(200, 'text/plain')
-        for result in engine.execute_query(self.server.engine, query):
-            self.wfile.write(json_dumps(result) + '\n')
+        if COLUMNS_MIME in (self.headers.getheader('accept') or ''):
+            self._send_columns(engine.execute_query(self.server.engine, query))
+            return
 
-def _create_engine(data_dir):
-    e = engine.AggregatorEngine()
+        # Failures before the first result are still reported as errors
+        results = iter(engine.execute_query(self.server.engine, query))
+        first = next(results, None)
+
+        writer = self.send_chunked_headers(200, 'application/x-ndjson')
+        if first is None:
+            writer.close()
+            return
+
+        try:
+            writer.write(json_dumps(first) + '\n')
+            for result in results:
+                writer.write(json_dumps(result) + '\n')
+        except Exception, e:
+            # Drop the connection without the last chunk, so the client
+            # can tell the response is incomplete.
+            self.log_error("Query %r failed: %s", query, e)
+            self.close_connection = 1
+            return
+        writer.close()
+
+    def _send_columns(self, results):
+        """
+        Send the flattened results as a binary columnar DataTable.
+        """
+        table = DataTable()
+        for result in results:
+            table.addRow(flatten_result(result))
+        self.send_data(200, COLUMNS_MIME, table.toBinary())
+
+    @HttpRequestHandler.match("/continuous$", commands='POST')
+    def continuous_register(self):
+        request = dict(self._post_data())
+        query = b64decode(request['query'])
+
+        qid = engine.register_query(self.server.engine, query)
+        self.send_data(200, 'application/json', json_dumps({'id': qid}))
+
+    @HttpRequestHandler.match("/continuous/(\w+)$", commands='GET')
+    def continuous_snapshot(self, qid):
+        cquery = self.server.engine.continuous_query(qid)
+        if cquery is None:
+            self.handle_not_found()
+            return
+
+        self._send_continuous(*cquery.snapshot())
+
+    @HttpRequestHandler.match("/continuous/(\w+)/delta$", commands='GET')
+    def continuous_delta(self, qid):
+        cquery = self.server.engine.continuous_query(qid)
+        if cquery is None:
+            self.handle_not_found()
+            return
+
+        since = int(dict(self.query).get('since', 0))
+        self._send_continuous(*cquery.delta(since))
+
+    @HttpRequestHandler.match("/continuous/(\w+)$", commands='DELETE')
+    def continuous_unregister(self, qid):
+        if self.server.engine.unregister(qid):
+            self.send_data(200, 'application/json', json_dumps({'id': qid}))
+        else:
+            self.handle_not_found()
+
+    def _send_continuous(self, version, results):
+        data = ''.join(json_dumps(result) + '\n' for result in results)
+        self.send_data(200, 'text/plain', data, {'X-Skvoz-Version': version})
+
+def _create_engine(data_dir, workers, cache_size):
+    e = engine.AggregatorEngine(workers, cache_size)
     e.add_source('file', sources.AggregatorFile())
     if data_dir:
         e.add_source('tsfile', sources.AggregatorTsFile(data_dir))
     return e
 
 class AggregatorUnixServer(UnixHttpServer):
-    def __init__(self, address, request_handler, data_dir):
-        self.engine = _create_engine(data_dir)
+    def __init__(self, address, request_handler, data_dir, workers=None, cache_size=None):
+        self.engine = _create_engine(data_dir, workers, cache_size)
         UnixHttpServer.__init__(self, address, request_handler)
 
 class AggregatorTcpServer(TcpHttpServer):
-    def __init__(self, address, request_handler, data_dir):
-        self.engine = _create_engine(data_dir)
+    def __init__(self, address, request_handler, data_dir, workers=None, cache_size=None):
+        self.engine = _create_engine(data_dir, workers, cache_size)
         TcpHttpServer.__init__(self, address, request_handler)
 
 class AggregationService(AbstractService):
     CLS_REQUEST_HANDLER = AggregatorRequestHandler
     CLS_UNIX_SERVER = AggregatorUnixServer
     CLS_TCP_SERVER = AggregatorTcpServer
+
+    def _stopping(self, *args):
+        self.server.engine.close()
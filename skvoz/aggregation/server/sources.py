@@ -32,8 +32,26 @@ from skvoz.util import tsfile
 
 import os
 
+def _time_range(time_period):
+    """
+    Convert the (start, end) datetime period to the inclusive msec range
+    used by tsfile to seek the files.
+    """
+    if not time_period:
+        return None, None
+
+    start, end = time_period
+    if start is not None:
+        start = date_to_timestamp(start) + (start.microsecond + 999) / 1000
+    if end is not None:
+        end = date_to_timestamp(end) + end.microsecond / 1000
+    return start, end
+
 class AggregatorSource(object):
-    def read_files(self, files):
+    def read_files(self, files, time_period=None, block_filter=None):
+        raise NotImplementedError
+
+    def read_raw_files(self, files, time_period=None, block_filter=None):
         raise NotImplementedError
 
     def files_from_keys(self, keys):
@@ -42,9 +60,31 @@ class AggregatorSource(object):
     def filter_files_by_time(self, files, start_time, end_time):
         return files
 
+    def cache_key(self, f, time_period=None):
+        """
+        Returns a key for the rows of the file in the time period, if the
+        file is immutable, or None if the file may change.
+        """
+        return None
+
+    def open_tail(self, f):
+        """
+        Returns a tsfile.Tail that follows the rows appended to the file,
+        or None if the file is immutable.
+        """
+        raise NotImplementedError
+
 class AggregatorFile(AggregatorSource):
-    def read_files(self, files):
-        return tsfile.read_files(files)
+    def read_files(self, files, time_period=None, block_filter=None):
+        start, end = _time_range(time_period)
+        return tsfile.read_files(files, None, start, end, block_filter)
+
+    def read_raw_files(self, files, time_period=None, block_filter=None):
+        start, end = _time_range(time_period)
+        return tsfile.read_raw_files(files, None, start, end, block_filter)
+
+    def open_tail(self, f):
+        return tsfile.Tail(f)
 
     def files_from_keys(self, keys):
         for key, files in keys.iteritems():
@@ -55,8 +95,13 @@ class AggregatorTsFile(AggregatorSource):
     def __init__(self, data_dir):
         self.data_dir = data_dir
 
-    def read_files(self, files):
-        return tsfile.read_files(files, self.data_dir)
+    def read_files(self, files, time_period=None, block_filter=None):
+        start, end = _time_range(time_period)
+        return tsfile.read_files(files, self.data_dir, start, end, block_filter)
+
+    def read_raw_files(self, files, time_period=None, block_filter=None):
+        start, end = _time_range(time_period)
+        return tsfile.read_raw_files(files, self.data_dir, start, end, block_filter)
 
     def files_from_keys(self, keys):
         for key, tskeys in keys.iteritems():
@@ -67,5 +112,23 @@ class AggregatorTsFile(AggregatorSource):
             yield key, files
 
     def filter_files_by_time(self, files, start_time, end_time):
-        return tsfile.filter_files_by_time(files, date_to_timestamp(start_time), date_to_timestamp(end_time))
+        return tsfile.filter_files_by_time(files, *_time_range((start_time, end_time)))
+
+    def cache_key(self, f, time_period=None):
+        name, consolidated = f
+        if not consolidated:
+            return None
+
+        # The whole file is read if it is inside the time period
+        st, et = tsfile.segment_range(name)
+        start, end = _time_range(time_period)
+        if (start is None or start <= st) and (end is None or et <= end):
+            return name
+        return name, start, end
+
+    def open_tail(self, f):
+        name, consolidated = f
+        if consolidated:
+            return None
+        return tsfile.Tail(os.path.join(self.data_dir, name))
 
@@ -25,33 +25,66 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from collections import defaultdict
+from skvoz.util.data import Column
+
+from operator import itemgetter
+from itertools import chain, islice, izip, repeat
 
 class Table(object):
+    """
+    Columnar table, each column is a Column: an array of numbers or
+    a list of interned strings. Rows are built only when requested.
+    """
     def __init__(self, name, columns):
         self.columns = list(columns)
         self.name = name
-        self.rows = []
+        self.data = [Column() for _ in self.columns]
 
     def count(self):
-        return len(self.rows)
+        return len(self.data[0]) if self.data else 0
 
     def insert(self, values):
         assert len(values) == len(self.columns)
         if isinstance(values, dict):
             values = [values[k] for k in self.columns]
-        self.rows.append(values)
+        for column, value in izip(self.data, values):
+            column.append(value)
 
     def bulk_insert(self, lvalues):
         for values in lvalues:
             self.insert(values)
 
+    def column(self, name):
+        """
+        Returns the Column object, without copying the values.
+        """
+        return self.data[self.columns.index(name)]
+
+    def project(self, columns):
+        """
+        Returns a table with only the specified columns, sharing the
+        Column objects with this table (don't insert in any of them).
+        """
+        table = Table(self.name, [])
+        table.columns = list(columns)
+        table.data = [self.column(c) for c in columns]
+        return table
+
+    @property
+    def rows(self):
+        """
+        The list of rows, as lists built from the columns: changing
+        them does not change the table.
+        """
+        return [list(row) for row in izip(*self.data)]
+
     def __len__(self):
-        return len(self.rows)
+        return self.count()
 
     def __iter__(self):
-        for row in self.rows:
-            yield dict((k, v) for k, v in zip(self.columns, row))
+        columns = self.columns
+        for row in izip(*self.data):
+            yield dict(izip(columns, row))
 
 class JoinTable(Table):
     def __init__(self, table_a, table_b):
@@ -71,16 +104,113 @@ class JoinTable(Table):
         assert len(values_a + values_b) == len(self.columns)
         return super(JoinTable, self).insert(values_a + values_b)
 
+    def append(self, row_a, row_b):
+        """
+        Add the row made by the raw rows (list of values) of A and B.
+        """
+        for column, value in izip(self.data, chain(row_a, row_b)):
+            column.append(value)
+
+class EqualityPredicate(object):
+    """
+    The join-predicate of an equi-join: a[keys_a] == b[keys_b].
+    The joins recognize it, and use a hash join or a sort-merge join
+    instead of comparing each row of A with each row of B.
+    """
+    def __init__(self, keys_a, keys_b):
+        assert len(keys_a) == len(keys_b)
+        self.keys_a = list(keys_a)
+        self.keys_b = list(keys_b)
+
+    def __call__(self, a_row, b_row):
+        for ka, kb in zip(self.keys_a, self.keys_b):
+            if a_row[ka] != b_row[kb]:
+                return False
+        return True
+
+    def swap(self):
+        return EqualityPredicate(self.keys_b, self.keys_a)
+
+def _key_getter(table, keys):
+    indexes = [table.columns.index(k) for k in keys]
+    if not indexes:
+        return lambda row: ()
+    return itemgetter(*indexes)
+
+def _is_sorted(rows, key):
+    for a, b in izip(rows, islice(rows, 1, None)):
+        if key(b) < key(a):
+            return False
+    return True
+
+def _hash_join(rows_a, rows_b, key_a, key_b):
+    """
+    Build a hash table on the rows of B and probe it with each row of A,
+    yielding (row_a, matching rows of B).
+    """
+    index = {}
+    for row_b in rows_b:
+        k = key_b(row_b)
+        matches = index.get(k)
+        if matches is None:
+            matches = index[k] = []
+        matches.append(row_b)
+
+    for row_a in rows_a:
+        yield row_a, index.get(key_a(row_a), ())
+
+def _merge_join(rows_a, rows_b, key_a, key_b):
+    """
+    Walk the rows of A and B, both sorted by key, yielding
+    (row_a, matching rows of B).
+    """
+    nrows_b = len(rows_b)
+    start = 0
+    for row_a in rows_a:
+        k = key_a(row_a)
+        while start < nrows_b and key_b(rows_b[start]) < k:
+            start += 1
+        end = start
+        while end < nrows_b and key_b(rows_b[end]) == k:
+            end += 1
+        yield row_a, rows_b[start:end]
+
+def _equi_join(table_a, table_b, predicate, outer=False):
+    """
+    Join on an EqualityPredicate, with a sort-merge join if both tables
+    are already sorted on the join keys (e.g. time series joined on the
+    time) or with a hash join otherwise. The rows are in the same order
+    of the nested loop join.
+    """
+    key_a = _key_getter(table_a, predicate.keys_a)
+    key_b = _key_getter(table_b, predicate.keys_b)
+    rows_a = table_a.rows
+    rows_b = table_b.rows
+    if _is_sorted(rows_a, key_a) and _is_sorted(rows_b, key_b):
+        pairs = _merge_join(rows_a, rows_b, key_a, key_b)
+    else:
+        pairs = _hash_join(rows_a, rows_b, key_a, key_b)
+
+    null_b_row = [None] * len(table_b.columns)
+    results = JoinTable(table_a, table_b)
+    for a_row, b_rows in pairs:
+        for b_row in b_rows:
+            results.append(a_row, b_row)
+        if outer and not b_rows:
+            results.append(a_row, null_b_row)
+    return results
+
 def cross_join(table_a, table_b):
     """
     Cross join returns the Cartesian product of rows from tables in the join.
     In other words, it will produce rows which combine each row from the first
     table with each row from the second table.
     """
+    a_rows = table_a.rows
     results = JoinTable(table_a, table_b)
-    for b_row in table_b:
-        for a_row in table_a:
-            results.insert(a_row, b_row)
+    for b_row in izip(*table_b.data):
+        for a_row in a_rows:
+            results.append(a_row, b_row)
     return results
 
 def inner_join(table_a, table_b, predicate_func):
@@ -92,11 +222,15 @@ def inner_join(table_a, table_b, predicate_func):
     column values for each matched pair of rows of A and B are combined into a
     result row.
     """
+    if isinstance(predicate_func, EqualityPredicate):
+        return _equi_join(table_a, table_b, predicate_func)
+
+    b_rows = zip(table_b, table_b.rows)
     results = JoinTable(table_a, table_b)
-    for a_row in table_a:
-        for b_row in table_b:
+    for a_row, a_values in izip(table_a, izip(*table_a.data)):
+        for b_row, b_values in b_rows:
             if predicate_func(a_row, b_row):
-                results.insert(a_row, b_row)
+                results.append(a_values, b_values)
     return results
 
 def equi_join(table_a, table_b, key_a, key_b):
@@ -104,7 +238,7 @@ def equi_join(table_a, table_b, key_a, key_b):
     An equi-join is a specific type of comparator-based join, or theta join,
     that uses only equality comparisons in the join-predicate.
     """
-    return inner_join(table_a, table_b, lambda a, b: a[key_a] == b[key_b])
+    return inner_join(table_a, table_b, EqualityPredicate([key_a], [key_b]))
 
 def natural_join(table_a, table_b):
     """
@@ -112,9 +246,8 @@ def natural_join(table_a, table_b):
     The join predicate arises implicitly by comparing all columns in both
     tables that have the same column-names in the joined tables.
     """
-    keys = set(table_a.columns) & set(table_b.columns)
-    predicate = lambda a, b: all([a[k] == b[k] for k in keys])
-    return inner_join(table_a, table_b, predicate)
+    keys = [k for k in table_a.columns if k in table_b.columns]
+    return inner_join(table_a, table_b, EqualityPredicate(keys, keys))
 
 def left_outer_join(table_a, table_b, predicate_func):
     """
@@ -129,17 +262,21 @@ def left_outer_join(table_a, table_b, predicate_func):
     table returns more than one matching row for it, the values in the right
     table will be repeated for each distinct row on the left table
     """
-    null_b_row = dict((k, None) for k in table_b.columns)
+    if isinstance(predicate_func, EqualityPredicate):
+        return _equi_join(table_a, table_b, predicate_func, outer=True)
 
+    null_b_row = [None] * len(table_b.columns)
+
+    b_rows = zip(table_b, table_b.rows)
     results = JoinTable(table_a, table_b)
-    for a_row in table_a:
+    for a_row, a_values in izip(table_a, izip(*table_a.data)):
         match = False
-        for b_row in table_b:
+        for b_row, b_values in b_rows:
             if predicate_func(a_row, b_row):
-                results.insert(a_row, b_row)
+                results.append(a_values, b_values)
                 match = True
         if match == False:
-            results.insert(a_row, null_b_row)
+            results.append(a_values, null_b_row)
     return results
 
 def right_outer_join(table_a, table_b, predicate_func):
@@ -150,17 +287,67 @@ def right_outer_join(table_a, table_b, predicate_func):
     at least once. If no matching row from the "left" table (A) exists, NULL
     will appear in columns from A for those records that have no match in B.
     """
+    if isinstance(predicate_func, EqualityPredicate):
+        predicate_func = predicate_func.swap()
     return left_outer_join(table_b, table_a, predicate_func)
 
+def asof_join(table_a, table_b, time_a, time_b, keys_a=(), keys_b=(), tolerance=None):
+    """
+    As-of join, to correlate two time series sampled at different times:
+    each row of A is combined with the last row of B (with the same keys)
+    whose time is not after the time of A, and not older than tolerance.
+    As in a left outer join, rows of A without a match get NULL in each
+    column from B. The rows are walked in time order, keeping only the
+    last row of B for each key.
+    """
+    ta = table_a.columns.index(time_a)
+    tb = table_b.columns.index(time_b)
+    key_a = _key_getter(table_a, keys_a)
+    key_b = _key_getter(table_b, keys_b)
+
+    rows_a = table_a.rows
+    if not _is_sorted(rows_a, itemgetter(ta)):
+        rows_a = sorted(rows_a, key=itemgetter(ta))
+    rows_b = table_b.rows
+    if not _is_sorted(rows_b, itemgetter(tb)):
+        rows_b = sorted(rows_b, key=itemgetter(tb))
+
+    null_b_row = [None] * len(table_b.columns)
+    nrows_b = len(rows_b)
+    last = {}
+    index = 0
+
+    results = JoinTable(table_a, table_b)
+    for a_row in rows_a:
+        ts = a_row[ta]
+        while index < nrows_b and rows_b[index][tb] <= ts:
+            last[key_b(rows_b[index])] = rows_b[index]
+            index += 1
+        b_row = last.get(key_a(a_row))
+        if b_row is None or (tolerance is not None and ts - b_row[tb] > tolerance):
+            b_row = null_b_row
+        results.append(a_row, b_row)
+    return results
+
 def group_by(table, keys):
-    groups = defaultdict(list)
-    for row in table:
-        gkey = tuple((k, row.pop(k)) for k in keys)
-        groups[gkey].append(row)
+    """
+    Group the table rows on the specified keys, returning the (key, table)
+    of each group sorted by key. The group tables don't have the key columns.
+    """
+    kdata = [table.column(k) for k in keys]
+    vindexes = [i for i, col in enumerate(table.columns) if col not in keys]
 
-    columns = [col for col in table.columns if col not in keys]
-    for key, rows in sorted(groups.iteritems()):
-        tgroups = Table(None, columns)
-        tgroups.bulk_insert(rows)
-        yield dict(key), tgroups
+    # Group the row indexes, the columns are copied once per group
+    groups = {}
+    gkeys = izip(*kdata) if kdata else repeat((), table.count())
+    for index, gkey in enumerate(gkeys):
+        group = groups.get(gkey)
+        if group is None:
+            group = groups[gkey] = []
+        group.append(index)
 
+    columns = [table.columns[i] for i in vindexes]
+    for gkey in sorted(groups):
+        tgroup = Table(None, columns)
+        tgroup.data = [table.data[i].take(groups[gkey]) for i in vindexes]
+        yield dict(zip(keys, gkey)), tgroup
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Vectorized execution of the numeric queries.
+
+When a query splits the data in a single number and stores only
+min/max/sum/sub/avg/count aggregates, grouping at most by key and time,
+each key is decoded in arrays of timestamps and values and the WHERE
+and STORE expressions are evaluated as array operations.
+
+    plan = vector.plan(context)
+    if plan is not None:
+        try:
+            results = plan.execute(source, keys)
+        except vector.NotVectorizable:
+            # fallback to the row by row execution
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from skvoz.aggregation.tdql.tokenizer import *
+from skvoz.aggregation.util import timestamps
+
+import re
+
+AGGREGATES = ('min', 'max', 'sum', 'sub', 'avg', 'count')
+
+RX_NOT_INTEGER = re.compile('[.eEnN]')
+
+class NotVectorizable(Exception):
+    pass
+
+def _is_integer(x):
+    return numpy.issubdtype(numpy.asarray(x).dtype, numpy.integer)
+
+def _divide(a, b):
+    # Keep the python 2 integer division semantic of the row executor
+    if _is_integer(a) and _is_integer(b):
+        return numpy.floor_divide(a, b)
+    return numpy.true_divide(a, b)
+
+if numpy is not None:
+    _BINARY_OPERATORS = {
+        '>':   numpy.greater,
+        '<':   numpy.less,
+        '<=':  numpy.less_equal,
+        '>=':  numpy.greater_equal,
+        '==':  numpy.equal,
+        '!=':  numpy.not_equal,
+        'AND': numpy.logical_and,
+        'OR':  numpy.logical_or,
+        '+':   numpy.add,
+        '-':   numpy.subtract,
+        '*':   numpy.multiply,
+        '/':   _divide,
+        '%':   numpy.mod,
+        '&':   numpy.bitwise_and,
+        '|':   numpy.bitwise_or,
+        '^':   numpy.bitwise_xor,
+        '<<':  numpy.left_shift,
+        '>>':  numpy.right_shift,
+    }
+
+def _expr_tree(rpn):
+    """
+    Convert the rpn tokens in a tree of tuples:
+        ('const', value), ('var', name), ('neg', expr),
+        ('op', operator, left, right), ('func', name, args)
+    """
+    stack = []
+    for token, symbol in rpn:
+        if token == TOKEN_NUMBER:
+            stack.append(('const', symbol))
+        elif token == TOKEN_KEYWORD:
+            stack.append(('var', symbol))
+        elif token == TOKEN_FUNCTION_ARGS:
+            stack.append(('args', [_expr_tree(arg) for arg in symbol]))
+        elif token == TOKEN_FUNCTION:
+            if not stack or stack[-1][0] != 'args':
+                raise NotVectorizable("Missing arguments for '%s'" % symbol)
+            stack.append(('func', symbol, stack.pop()[1]))
+        elif token == TOKEN_OPERATOR:
+            if len(stack) > 1:
+                if symbol not in _BINARY_OPERATORS:
+                    raise NotVectorizable("Operator '%s' not supported" % symbol)
+                right = stack.pop()
+                left = stack.pop()
+                stack.append(('op', symbol, left, right))
+            elif symbol == '-' and stack:
+                stack.append(('neg', stack.pop()))
+            else:
+                raise NotVectorizable("Operator '%s' not supported" % symbol)
+        else:
+            raise NotVectorizable("Token %r not supported" % symbol)
+
+    if len(stack) != 1:
+        raise NotVectorizable("Expression not supported")
+    return stack[0]
+
+def _check_value_tree(tree, varname):
+    kind = tree[0]
+    if kind == 'var':
+        if tree[1] != varname:
+            raise NotVectorizable("Unknown variable '%s'" % tree[1])
+    elif kind == 'neg':
+        _check_value_tree(tree[1], varname)
+    elif kind == 'op':
+        _check_value_tree(tree[2], varname)
+        _check_value_tree(tree[3], varname)
+    elif kind != 'const':
+        raise NotVectorizable("Function not supported here")
+
+def _check_store_tree(tree, varname, seen):
+    kind = tree[0]
+    if kind == 'func':
+        name, args = tree[1], tree[2]
+        # The row executor shares the same function state between calls
+        if name not in AGGREGATES or name in seen or len(args) != 1:
+            raise NotVectorizable("Function '%s' not supported" % name)
+        seen.add(name)
+        _check_value_tree(args[0], varname)
+    elif kind == 'neg':
+        _check_store_tree(tree[1], varname, seen)
+    elif kind == 'op':
+        _check_store_tree(tree[2], varname, seen)
+        _check_store_tree(tree[3], varname, seen)
+    elif kind != 'const':
+        raise NotVectorizable("Variables must be aggregated")
+
+def _eval_tree(tree, values, aggregate=None):
+    kind = tree[0]
+    if kind == 'const':
+        return tree[1]
+    if kind == 'var':
+        return values
+    if kind == 'neg':
+        return numpy.negative(_eval_tree(tree[1], values, aggregate))
+    if kind == 'op':
+        left = _eval_tree(tree[2], values, aggregate)
+        right = _eval_tree(tree[3], values, aggregate)
+        return _BINARY_OPERATORS[tree[1]](left, right)
+    assert kind == 'func'
+    return aggregate(tree[1], _eval_tree(tree[2][0], values))
+
+def _reduce(name, values, starts, counts):
+    if name == 'count':
+        return counts
+    if name == 'min':
+        return numpy.minimum.reduceat(values, starts)
+    if name == 'max':
+        return numpy.maximum.reduceat(values, starts)
+
+    total = numpy.add.reduceat(values, starts)
+    if name == 'sum':
+        return total
+    if name == 'sub':
+        return numpy.negative(total)
+    assert name == 'avg'
+    return _divide(total, counts)
+
+def _decode_values(values):
+    data = numpy.array(values)
+    for dtype in (numpy.int64, numpy.float64):
+        try:
+            return data.astype(dtype)
+        except (ValueError, OverflowError):
+            pass
+    raise NotVectorizable("Not a numeric key")
+
+def _decode_content(content):
+    """
+    Decode the 'msec value' lines of a ts file in two arrays
+    (timestamps in seconds, values).
+    """
+    nlines = content.count('\n')
+    if content and not content.endswith('\n'):
+        nlines += 1
+
+    # Fast path, let numpy parse the whole content
+    data = numpy.fromstring(content, dtype=numpy.float64, sep=' ')
+    if len(data) == 2 * nlines:
+        values = data[1::2]
+        if not RX_NOT_INTEGER.search(content):
+            values = values.astype(numpy.int64)
+        return data[0::2] / 1000.0, values
+
+    tokens = content.split()
+    if len(tokens) != 2 * nlines:
+        raise NotVectorizable("Not a single value key")
+
+    try:
+        ts = numpy.array(tokens[0::2]).astype(numpy.int64) / 1000.0
+    except (ValueError, OverflowError):
+        raise NotVectorizable("Invalid timestamps")
+    return ts, _decode_values(tokens[1::2])
+
+def _time_buckets(ts, period, width):
+    bucket = timestamps.TimeBucket(period, width)
+    keys = []
+    starts = []
+    index = 0
+    length = len(ts)
+    while index < length:
+        key, _, end = bucket.range(ts[index])
+        keys.append(key)
+        starts.append(index)
+        index = max(index + 1, ts.searchsorted(end, 'left'))
+    return keys, starts
+
+def _value_buckets(ts):
+    if len(ts) == 0:
+        return [], []
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(ts)) + 1))
+    return [ts[i].item() for i in starts], list(starts)
+
+class VectorPlan(object):
+    def __init__(self, context, varname, filters, functions):
+        self.context = context
+        self.varname = varname
+        self.filters = filters
+        self.functions = functions
+        self.group_keys = list(context.group_keys or [])
+
+    def execute(self, source, keys):
+        """
+        Returns the list of (groups, results) of the query, raises
+        NotVectorizable if the data can't be decoded as numbers.
+        """
+        context = self.context
+        group_keys = self.group_keys
+
+        streams = []
+        for key, files in source.files_from_keys(keys):
+            if context.time_period:
+                files = source.filter_files_by_time(files, *context.time_period)
+            streams.append((key, self._read(source, files)))
+
+        if '__key__' not in group_keys and len(streams) > 1:
+            ts = numpy.concatenate([s[1][0] for s in streams])
+            values = numpy.concatenate([s[1][1] for s in streams])
+            order = ts.argsort(kind='mergesort')
+            streams = [(None, (ts[order], values[order]))]
+
+        results = []
+        for key, (ts, values) in streams:
+            for gkey, result in self._aggregate(ts, values):
+                if '__key__' in group_keys:
+                    gkey['__key__'] = key
+                results.append((tuple((k, gkey[k]) for k in group_keys), result))
+
+        if not group_keys:
+            if not results:
+                return [(None, [])]
+            return [(None, [results[0][1]])]
+
+        results.sort()
+        return [(dict(gkey), [result]) for gkey, result in results]
+
+    def _read(self, source, files):
+        ts = []
+        values = []
+        scan_filter = self.context.scan_filter
+        block_filter = scan_filter.skip_block if scan_filter is not None else None
+        for content in source.read_raw_files(files, self.context.time_period, block_filter):
+            ts_data, values_data = _decode_content(content)
+            ts.append(ts_data)
+            values.append(values_data)
+
+        if not ts:
+            return numpy.array([], dtype=numpy.float64), numpy.array([], dtype=numpy.int64)
+
+        ts = numpy.concatenate(ts)
+        values = numpy.concatenate(values)
+        vtype = self.context.data_split.types[0]
+        if vtype == 'float':
+            values = values.astype(numpy.float64)
+        elif vtype == 'int' and values.dtype != numpy.int64:
+            raise NotVectorizable("Not an integer key")
+        order = ts.argsort(kind='mergesort')
+        ts = ts[order]
+        values = values[order]
+
+        mask = None
+        if self.context.time_period:
+            start, end = self.context.time_period
+            mask = ts >= timestamps.date_to_epoch(start)
+            if end is not None:
+                mask &= ts <= timestamps.date_to_epoch(end)
+
+        for tree in self.filters:
+            keep = numpy.broadcast_to(numpy.asarray(_eval_tree(tree, values), dtype=bool), ts.shape)
+            mask = keep if mask is None else (mask & keep)
+
+        if mask is not None:
+            ts = ts[mask]
+            values = values[mask]
+        return ts, values
+
+    def _aggregate(self, ts, values):
+        if len(ts) == 0:
+            return
+
+        if self.context.group_period:
+            keys, starts = _time_buckets(ts, self.context.group_period, self.context.group_width)
+        elif '__ts__' in self.group_keys:
+            keys, starts = _value_buckets(ts)
+        else:
+            keys, starts = [None], [0]
+
+        starts = numpy.array(starts, dtype=numpy.intp)
+        counts = numpy.diff(numpy.append(starts, len(ts)))
+        aggregate = lambda name, x: _reduce(name, numpy.broadcast_to(x, ts.shape), starts, counts)
+
+        columns = {}
+        for name, tree in self.functions:
+            column = numpy.asarray(_eval_tree(tree, values, aggregate))
+            columns[name] = numpy.broadcast_to(column, counts.shape)
+
+        for i, key in enumerate(keys):
+            gkey = {} if key is None else {'__ts__': key}
+            yield gkey, dict((name, column[i].item()) for name, column in columns.iteritems())
+
+def plan(context):
+    """
+    Returns a VectorPlan if the query can be vectorized, None otherwise.
+    """
+    if numpy is None or context.store is None or context.data_split is None:
+        return None
+
+    varnames = context.data_split.varnames
+    if len(varnames) != 1 or context.data_split.types[0] in ('str', 'bool'):
+        return None
+
+    if set(context.group_keys or []) - set(['__ts__', '__key__']):
+        return None
+
+    if context.time_period:
+        start, end = context.time_period
+        if not all(hasattr(d, 'timetuple') for d in (start, end) if d is not None):
+            return None
+
+    try:
+        filters = []
+        for func in context.data_filters:
+            rpn = getattr(func, 'rpn', None)
+            if rpn is None:
+                return None
+            tree = _expr_tree(rpn)
+            _check_value_tree(tree, varnames[0])
+            filters.append(tree)
+
+        functions = []
+        for name, func in context.store.results.iteritems():
+            tree = _expr_tree(func.content)
+            _check_store_tree(tree, varnames[0], set())
+            functions.append((name, tree))
+    except NotVectorizable:
+        return None
+
+    return VectorPlan(context, varnames[0], filters, functions)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Compile the RPN expressions into python functions.
+
+The rpn tokens are translated once per query in the source of a function
+that evaluates the expression in a straight sequence of statements,
+with the variables and the STORE functions resolved ahead of time:
+
+    expr = compile_rpn(rpn, functions)
+    if expr is not None:
+        value = expr(items)
+
+Expressions that can't be compiled (unary operators, unknown operators,
+...) return None and are left to the rpn_evaluate() interpreter.
+"""
+
+from skvoz.aggregation.tdql.tokenizer import *
+
+_COMPARE_OPERATORS = ('>', '<', '<=', '>=', '==', '!=')
+_LOGIC_OPERATORS = ('AND', 'OR')
+_NUMERIC_OPERATORS = ('+', '-', '*', '/', '%', '&', '|', '^', '<<', '>>')
+
+_CACHE_SIZE = 256
+_cache = {}
+
+class _Uncompilable(Exception):
+    pass
+
+def _rpn_key(rpn):
+    key = []
+    for token, symbol in rpn:
+        if token == TOKEN_FUNCTION_ARGS:
+            symbol = tuple(_rpn_key(arg) for arg in symbol)
+        key.append((token, symbol))
+    return tuple(key)
+
+class _CodeGen(object):
+    def __init__(self):
+        self.lines = []
+        self.functions = []
+        self.count = 0
+
+    def temp(self, expr):
+        name = 't%d' % self.count
+        self.count += 1
+        self.lines.append('%s = %s' % (name, expr))
+        return name
+
+    def expression(self, rpn):
+        """
+        Emit the statements of the rpn expression,
+        returning the name of the variable with the result.
+        """
+        stack = []
+        for token, symbol in rpn:
+            if token in (TOKEN_NUMBER, TOKEN_STRING, TOKEN_BOOLEAN):
+                stack.append(('const', repr(symbol)))
+            elif token == TOKEN_KEYWORD:
+                stack.append(('var', symbol))
+            elif token == TOKEN_FUNCTION_ARGS:
+                stack.append(('args', symbol))
+            elif token == TOKEN_FUNCTION:
+                if not stack or stack[-1][0] != 'args' or not stack[-1][1]:
+                    raise _Uncompilable(symbol)
+                args = [self.expression(arg) for arg in stack.pop()[1]]
+                if symbol not in self.functions:
+                    self.functions.append(symbol)
+                fname = 'f%d' % self.functions.index(symbol)
+                stack.append(('temp', self.temp('%s(%s)[1]' % (fname, ', '.join(args)))))
+            elif token == TOKEN_OPERATOR:
+                if len(stack) < 2:
+                    raise _Uncompilable(symbol)
+                right = self.value(stack.pop())
+                left = self.value(stack.pop())
+                stack.append(('temp', self.binary(symbol, left, right)))
+            else:
+                raise _Uncompilable(symbol)
+
+        if len(stack) != 1:
+            raise _Uncompilable(rpn)
+
+        # A variable alone is replaced with its value, if any
+        kind, value = stack[0]
+        if kind == 'var':
+            return self.temp('items.get(%r, %r)' % (value, value))
+        return self.value(stack[0])
+
+    def applies(self, rpn):
+        """
+        Emit the apply() of each function of the rpn expression on its
+        arguments, without evaluating the expression on their results.
+        """
+        args = None
+        for token, symbol in rpn:
+            if token == TOKEN_FUNCTION_ARGS:
+                args = symbol
+            elif token == TOKEN_FUNCTION:
+                if not args:
+                    raise _Uncompilable(symbol)
+                values = [self.expression(arg) for arg in args]
+                if symbol not in self.functions:
+                    self.functions.append(symbol)
+                fname = 'f%d' % self.functions.index(symbol)
+                self.lines.append('%s.apply(%s)' % (fname, ', '.join(values)))
+                args = None
+            elif token in (TOKEN_KEYWORD, TOKEN_FUNCTION_ARGS):
+                raise _Uncompilable(symbol)
+        return 'None'
+
+    def value(self, operand):
+        kind, value = operand
+        if kind == 'var':
+            return self.temp('items[%r]' % value)
+        if kind == 'args':
+            raise _Uncompilable(value)
+        return value
+
+    def binary(self, symbol, left, right):
+        if symbol in _COMPARE_OPERATORS:
+            return self.temp('%s %s %s' % (left, symbol, right))
+        if symbol in _LOGIC_OPERATORS:
+            # Both the operands are already evaluated, as in rpn_evaluate()
+            return self.temp('%s %s %s' % (left, symbol.lower(), right))
+        if symbol in _NUMERIC_OPERATORS:
+            if not left[:1].isdigit():
+                self.lines.append('if isinstance(%s, basestring): _string_operation(%s, %r, %s)' % (left, left, symbol, right))
+            return self.temp('%s %s %s' % (left, symbol, right))
+        raise _Uncompilable(symbol)
+
+    def source(self, result):
+        lines = ['def _make(functions):']
+        for i, name in enumerate(self.functions):
+            lines.append('    f%d = functions[%r]' % (i, name))
+        lines.append('    def _expr(items):')
+        lines.extend('        ' + line for line in self.lines)
+        lines.append('        return %s' % result)
+        lines.append('    return _expr')
+        return '\n'.join(lines) + '\n'
+
+def _string_operation(left, operation, right):
+    raise Exception("String type not supported '%r %s %r'" % (left, operation, right))
+
+def _compile_factory(rpn, apply_only=False):
+    codegen = _CodeGen()
+    try:
+        if apply_only:
+            result = codegen.applies(rpn)
+        else:
+            result = codegen.expression(rpn)
+    except _Uncompilable:
+        return None
+
+    namespace = {'_string_operation': _string_operation}
+    code = compile(codegen.source(result), '<tdql>', 'exec', 0, True)
+    exec code in namespace
+    return namespace['_make']
+
+def compile_rpn(rpn, functions=None):
+    """
+    Returns a function that evaluates the rpn expression on the items
+    of a row, or None if the expression can't be compiled.
+    functions maps the names of the functions used by the expression
+    to the objects to call.
+    """
+    if not rpn:
+        return None
+
+    key = _rpn_key(rpn)
+    try:
+        factory = _cache[key]
+    except KeyError:
+        if len(_cache) >= _CACHE_SIZE:
+            _cache.clear()
+        factory = _cache[key] = _compile_factory(rpn)
+
+    if factory is None:
+        return None
+    return factory(functions or {})
+
+def compile_apply(rpn, functions):
+    """
+    Returns a function that applies the items of a row to the functions
+    used by the rpn expression, leaving the evaluation of the expression
+    on the function results to the end of the group. Returns None if the
+    function arguments can't be compiled, or a variable is used outside
+    of a function.
+    """
+    if not rpn:
+        return None
+
+    key = ('apply', _rpn_key(rpn))
+    try:
+        factory = _cache[key]
+    except KeyError:
+        if len(_cache) >= _CACHE_SIZE:
+            _cache.clear()
+        factory = _cache[key] = _compile_factory(rpn, True)
+
+    if factory is None:
+        return None
+    return factory(functions)
+
+def uses_functions(rpn):
+    for token, _ in rpn:
+        if token == TOKEN_FUNCTION:
+            return True
+    return False
@@ -26,14 +26,39 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from skvoz.aggregation.tdql.tokenizer import TOKEN_NUMBER, TOKEN_STRING
-from skvoz.aggregation.tdql.rpn import rpn_evaluate
+from skvoz.aggregation.tdql.tokenizer import TOKEN_KEYWORD, TOKEN_FUNCTION
+from skvoz.aggregation.tdql.tokenizer import TOKEN_FUNCTION_ARGS
+from skvoz.aggregation.tdql.compiler import compile_rpn, compile_apply, uses_functions
+from skvoz.aggregation.tdql.rpn import rpn_evaluate, rpn_to_infix_string
+from skvoz.aggregation.util import sketches
+from collections import deque
+from itertools import chain
+
+def _result_function(func):
+    return lambda *args: func.result()
+
+def function_symbols(rpn):
+    """
+    Returns the symbols of the functions used by the rpn expression,
+    including the ones nested in the arguments of other functions.
+    """
+    for token, symbol in rpn:
+        if token == TOKEN_FUNCTION_ARGS:
+            for arg in symbol:
+                for fsymbol in function_symbols(arg):
+                    yield fsymbol
+        elif token == TOKEN_FUNCTION:
+            yield symbol
 
 class _Function(object):
+    MERGEABLE = False
+    WINDOW = False
+
     def __init__(self):
         self.reset()
 
-    def __call__(self, items):
-        self.apply(items)
+    def __call__(self, *args):
+        self.apply(*args)
         return self.result()
 
     def reset(self):
@@ -45,6 +70,13 @@ class _Function(object):
     def apply(self, items):
         raise NotImplementedError
 
+    def merge(self, other):
+        """
+        Merge the state of other, computed on a different set of rows,
+        in this function state.
+        """
+        raise NotImplementedError
+
     @staticmethod
     def parse_number(value):
         if not isinstance(value, basestring):
@@ -57,24 +89,106 @@ class _Function(object):
         return value
 
 class Executor(_Function):
+    """
+    Evaluate the STORE expression on every row. The expression is compiled,
+    if it fails on a row with no functions applied the interpreter is used.
+    When every variable is inside a function, the rows are only applied to
+    the functions and the expression is evaluated on their results once,
+    when the result is requested.
+    """
     def __init__(self, functions, rpn):
         self.functions = dict((k, f()) for k, f in functions.iteritems())
         self.fresult = None
         self.rpn = rpn
+        self._compile()
+
+    def _compile(self):
+        self._expr = compile_rpn(self.rpn, self.functions)
+        self._pure = not uses_functions(self.rpn)
+        self._apply = None
+        if not self._pure and self.is_mergeable():
+            self._apply = compile_apply(self.rpn, self.functions)
+        self._windows = [self.functions[symbol] for symbol in set(function_symbols(self.rpn))
+                         if self.functions[symbol].WINDOW]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_expr']
+        del state['_apply']
+        del state['_windows']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
 
     def reset(self):
         for f in self.functions.itervalues():
             f.reset()
+        if self._apply is not None:
+            self.fresult = None
 
     def result(self):
+        if self.fresult is None:
+            self.fresult = self._evaluate_results()
         if len(self.fresult) == 1:
             return self.fresult[0][1]
         return [r[1] for r in self.fresult]
 
     def apply(self, items):
+        for func in self._windows:
+            func.time = items['__time__']
+        if self._apply is not None:
+            try:
+                self._apply(items)
+            except Exception, e:
+                q = rpn_to_infix_string(self.rpn)
+                raise Exception("Evaluation fail on %r, rpn %r: %s" % (items, q, e))
+            self.fresult = None
+            return
+        if self._expr is not None:
+            try:
+                self.fresult = ((None, self._expr(items)),)
+                return
+            except Exception, e:
+                if not self._pure:
+                    q = rpn_to_infix_string(self.rpn)
+                    raise Exception("Evaluation fail on %r, rpn %r: %s" % (items, q, e))
         self.fresult = rpn_evaluate(self.rpn, dict(self.functions, **items))
 
+    def is_mergeable(self):
+        """
+        The expression result can be computed from merged states only if
+        every variable is inside a function and every function is mergeable.
+        """
+        for token, symbol in self.rpn:
+            if token == TOKEN_KEYWORD:
+                return False
+            if token == TOKEN_FUNCTION and not self.functions[symbol].MERGEABLE:
+                return False
+            if token == TOKEN_FUNCTION_ARGS:
+                for arg in symbol:
+                    if any(t == TOKEN_FUNCTION for t, _ in arg):
+                        return False
+        return True
+
+    def merge(self, other):
+        for name, func in self.functions.iteritems():
+            # Functions not used by a mergeable expression have no state
+            if func.MERGEABLE:
+                func.merge(other.functions[name])
+
+        self.fresult = self._evaluate_results()
+
+    def _evaluate_results(self):
+        # Evaluate the expression on the function results
+        context = dict((name, _result_function(func))
+                       for name, func in self.functions.iteritems())
+        return rpn_evaluate(self.rpn, context)
+
 class MinFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.value = None
 
@@ -85,7 +199,13 @@ class MinFunction(_Function):
         value = self.parse_number(value)
         self.value = value if self.value is None else min(self.value, value)
 
+    def merge(self, other):
+        if other.value is not None:
+            self.apply(other.value)
+
 class MaxFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.value = None
 
@@ -96,7 +216,13 @@ class MaxFunction(_Function):
         value = self.parse_number(value)
         self.value = value if self.value is None else max(self.value, value)
 
+    def merge(self, other):
+        if other.value is not None:
+            self.apply(other.value)
+
 class SumFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.total = 0
 
@@ -106,7 +232,12 @@ class SumFunction(_Function):
     def apply(self, value):
         self.total += self.parse_number(value)
 
+    def merge(self, other):
+        self.total += other.total
+
 class SubFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.total = 0
 
@@ -116,7 +247,12 @@ class SubFunction(_Function):
     def apply(self, value):
         self.total -= self.parse_number(value)
 
+    def merge(self, other):
+        self.total += other.total
+
 class AvgFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.total = 0
         self.count = 0
@@ -128,7 +264,13 @@ class AvgFunction(_Function):
         self.total += self.parse_number(value)
         self.count += 1
 
+    def merge(self, other):
+        self.total += other.total
+        self.count += other.count
+
 class CountFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.count = 0
 
@@ -138,6 +280,9 @@ class CountFunction(_Function):
     def apply(self, value):
         self.count += 1
 
+    def merge(self, other):
+        self.count += other.count
+
 class ListFunction(_Function):
     def reset(self):
         self.data = []
@@ -149,6 +294,8 @@ class ListFunction(_Function):
         self.data.append(value)
 
 class SetFunction(_Function):
+    MERGEABLE = True
+
     def reset(self):
         self.data = set()
 
@@ -157,3 +304,225 @@ class SetFunction(_Function):
 
     def apply(self, value):
         self.data.add(value)
+
+    def merge(self, other):
+        self.data |= other.data
+
+class PercentileFunction(_Function):
+    """
+    percentile(x, 99): approximate percentile (1% relative error)
+    """
+    MERGEABLE = True
+
+    def reset(self):
+        self.sketch = sketches.DDSketch()
+        self.percentile = None
+
+    def result(self):
+        return TOKEN_NUMBER, self.sketch.quantile(self.percentile / 100.0)
+
+    def apply(self, value, percentile):
+        self.percentile = self.parse_number(percentile)
+        self.sketch.add(self.parse_number(value))
+
+    def merge(self, other):
+        if other.percentile is not None:
+            self.percentile = other.percentile
+        self.sketch.merge(other.sketch)
+
+class CountDistinctFunction(_Function):
+    """
+    count_distinct(x): approximate number of distinct values
+    """
+    MERGEABLE = True
+
+    def reset(self):
+        self.sketch = sketches.HyperLogLog()
+
+    def result(self):
+        return TOKEN_NUMBER, self.sketch.cardinality()
+
+    def apply(self, value):
+        self.sketch.add(value)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+class TopKFunction(_Function):
+    """
+    topk(x, n): the n most frequent values, as [value, count] (approximate)
+    """
+    MERGEABLE = True
+
+    def reset(self):
+        self.sketch = sketches.CountMinTopK()
+        self.n = None
+
+    def result(self):
+        return TOKEN_STRING, self.sketch.top(self.n or 0)
+
+    def apply(self, value, n):
+        if self.n is None:
+            self.n = int(self.parse_number(n))
+            self.sketch.capacity = max(self.sketch.capacity, 4 * self.n)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        if other.n is not None:
+            self.n = other.n
+        self.sketch.merge(other.sketch)
+
+def _increase(previous, value):
+    # A counter lower than the previous value has been reset
+    return value - previous if value >= previous else value
+
+class _WindowFunction(_Function):
+    """
+    Functions of the time ordered rows of a group, the Executor sets
+    self.time to the row timestamp before calling apply().
+    Partial states, computed on different time ranges, are merged
+    looking at their first timestamp.
+    """
+    MERGEABLE = True
+    WINDOW = True
+    time = None
+
+class DeltaFunction(_WindowFunction):
+    """
+    delta(x): difference between the last and the first value
+    """
+    def reset(self):
+        self.first = None
+        self.last = None
+
+    def result(self):
+        if self.first is None:
+            return TOKEN_NUMBER, None
+        return TOKEN_NUMBER, self.last[1] - self.first[1]
+
+    def apply(self, value):
+        value = (self.time, self.parse_number(value))
+        if self.first is None:
+            self.first = value
+        self.last = value
+
+    def merge(self, other):
+        if other.first is None:
+            return
+        if self.first is None or other.first < self.first:
+            self.first = other.first
+        if self.last is None or other.last > self.last:
+            self.last = other.last
+
+class DerivativeFunction(DeltaFunction):
+    """
+    derivative(x): change per second between the first and the last value
+    (0 until a second sample is seen)
+    """
+    def result(self):
+        if self.first is None:
+            return TOKEN_NUMBER, None
+        if self.last[0] == self.first[0]:
+            return TOKEN_NUMBER, 0.0
+        delta = self.last[1] - self.first[1]
+        return TOKEN_NUMBER, delta / float(self.last[0] - self.first[0])
+
+class RateFunction(DeltaFunction):
+    """
+    rate(x): per second increase of a counter, handling the counter resets
+    (0 until a second sample is seen)
+    """
+    def reset(self):
+        DeltaFunction.reset(self)
+        self.increase = 0
+
+    def result(self):
+        if self.first is None:
+            return TOKEN_NUMBER, None
+        if self.last[0] == self.first[0]:
+            return TOKEN_NUMBER, 0.0
+        return TOKEN_NUMBER, self.increase / float(self.last[0] - self.first[0])
+
+    def apply(self, value):
+        value = self.parse_number(value)
+        if self.last is not None:
+            self.increase += _increase(self.last[1], value)
+        else:
+            self.first = (self.time, value)
+        self.last = (self.time, value)
+
+    def merge(self, other):
+        if other.first is None:
+            return
+        if self.first is None:
+            self.first, self.last, self.increase = other.first, other.last, other.increase
+            return
+        a, b = (self, other) if self.first <= other.first else (other, self)
+        self.increase = a.increase + b.increase + _increase(a.last[1], b.first[1])
+        self.first, self.last = a.first, b.last
+
+class MovingAvgFunction(_WindowFunction):
+    """
+    moving_avg(x, N): average of the last N values
+    """
+    def reset(self):
+        self.window = None
+        self.total = 0
+
+    def result(self):
+        if not self.window:
+            return TOKEN_NUMBER, None
+        return TOKEN_NUMBER, self.total / float(len(self.window))
+
+    def apply(self, value, n):
+        if self.window is None:
+            self.window = deque(maxlen=int(self.parse_number(n)))
+        value = self.parse_number(value)
+        if len(self.window) == self.window.maxlen:
+            self.total -= self.window[0][1]
+        self.window.append((self.time, value))
+        self.total += value
+
+    def merge(self, other):
+        if not other.window:
+            return
+        window = other.window if self.window is None else self.window
+        rows = sorted(chain(self.window or [], other.window))
+        self.window = deque(rows[-window.maxlen:], maxlen=window.maxlen)
+        self.total = sum(value for _, value in self.window)
+
+class EwmaFunction(_WindowFunction):
+    """
+    ewma(x[, alpha]): exponentially weighted moving average (alpha 0.5)
+
+    The state is kept as: ewma = acc + decay * first value, so that the
+    ewma of two consecutive ranges is: acc2 + decay2 * ewma1
+    """
+    def reset(self):
+        self.first = None
+        self.acc = 0.0
+        self.decay = 1.0
+
+    def result(self):
+        if self.first is None:
+            return TOKEN_NUMBER, None
+        return TOKEN_NUMBER, self.acc + self.decay * self.first[1]
+
+    def apply(self, value, alpha=0.5):
+        alpha = self.parse_number(alpha)
+        value = self.parse_number(value)
+        if self.first is None:
+            self.first = (self.time, value)
+        self.acc = alpha * value + (1 - alpha) * self.acc
+        self.decay *= (1 - alpha)
+
+    def merge(self, other):
+        if other.first is None:
+            return
+        if self.first is None:
+            self.first, self.acc, self.decay = other.first, other.acc, other.decay
+            return
+        a, b = (self, other) if self.first <= other.first else (other, self)
+        self.acc = b.acc + b.decay * a.acc
+        self.decay = a.decay * b.decay
+        self.first = a.first
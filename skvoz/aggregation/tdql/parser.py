@@ -41,6 +41,14 @@ _FUNCTIONS_MAP = {
     'set':   functions.SetFunction,
     'list':  functions.ListFunction,
     'count': functions.CountFunction,
+    'percentile': functions.PercentileFunction,
+    'count_distinct': functions.CountDistinctFunction,
+    'topk': functions.TopKFunction,
+    'rate': functions.RateFunction,
+    'delta': functions.DeltaFunction,
+    'derivative': functions.DerivativeFunction,
+    'moving_avg': functions.MovingAvgFunction,
+    'ewma': functions.EwmaFunction,
 }
 
 def _strip_plural(symbol):
@@ -120,6 +128,9 @@ class StmtTime(Stmt):
     TIME 5 months
     TIME 10 days
     TIME 5 months 15 days
+
+    Relative times (e.g. 5 months) are resolved each time start and end
+    are read, so a parsed query can be executed again later.
     """
     SEPARATORS = (TOKEN_COMMA, TOKEN_PARENTHESES_OPEN, TOKEN_PARENTHESES_CLOSE)
 
@@ -133,8 +144,19 @@ class StmtTime(Stmt):
     ]
 
     def __init__(self):
-        self.start = None
-        self.end = None
+        self._start = None
+        self._end = None
+
+    @property
+    def start(self):
+        return self._resolve(self._start)
+
+    @property
+    def end(self):
+        return self._resolve(self._end)
+
+    def is_relative(self):
+        return isinstance(self._start, tuple) or isinstance(self._end, tuple)
 
     def add(self, token, symbol):
         if token in self.SEPARATORS:
@@ -145,23 +167,31 @@ class StmtTime(Stmt):
             if not sym.endswith('s'): sym += 's'
 
             if hasattr(self, sym):
-                func = getattr(self, sym)
-                if self.end is not None:
-                    self.end = func(self.end)
+                # Resolved here only to validate it, start/end resolve it again
+                if self._end is not None:
+                    self._end = (sym, self._end)
+                    self._resolve(self._end)
                 else:
-                    self.start = func(self.start)
+                    self._start = (sym, self._start)
+                    self._resolve(self._start)
                 return
 
         if isinstance(symbol, basestring):
             symbol = self._from_string(symbol)
 
-        if self.start is None:
-            self.start = symbol
-        elif self.end is None:
-            self.end = symbol
+        if self._start is None:
+            self._start = symbol
+        elif self._end is None:
+            self._end = symbol
         else:
             raise StmtSyntaxError("Time interval is just start-end!")
 
+    def _resolve(self, value):
+        if isinstance(value, tuple):
+            sym, value = value
+            return getattr(self, sym)(self._resolve(value))
+        return value
+
     def __repr__(self):
         return 'Time Interval %r-%r' % (self.start, self.end)
 
@@ -213,9 +243,13 @@ class StmtTime(Stmt):
 class StmtSplit(Stmt):
     """
     SPLIT a, b, c ON ':'
+    SPLIT host:str, ms:float
     """
+    TYPES = ('str', 'int', 'float', 'bool')
+
     def __init__(self):
         self.results = []
+        self.types = []
         self.delimiters = None
 
     def add(self, token, symbol):
@@ -227,38 +261,61 @@ class StmtSplit(Stmt):
             return
 
         if self.delimiters is None:
-            self.results.append(symbol)
+            name, _, vtype = symbol.partition(':')
+            if vtype and vtype.lower() not in self.TYPES:
+                raise StmtSyntaxError("Invalid split type '%s'" % vtype)
+            self.results.append(name)
+            self.types.append(vtype.lower() or None)
         else:
             self.delimiters.append(symbol)
 
     def __repr__(self):
-        return 'Split %r On %r' % (self.results, self.delimiters)
+        return 'Split %r On %r' % (zip(self.results, self.types), self.delimiters)
 
 class StmtGroupBy(Stmt):
     """
     GROUP BY key, month, year, ...
+    GROUP BY key, 5 minutes
     """
-    TIME_GROUPS = ('year', 'month', 'day', 'week', 'hour', 'minute')
+    TIME_GROUPS = ('year', 'month', 'day', 'week', 'hour', 'minute', 'second')
 
     def __init__(self):
         self.time_period = None
+        self.time_width = 1
         self.keys = []
+        self._width = None
 
     def __contains__(self, key):
         return key in self.groups
 
+    def close(self):
+        if self._width is not None:
+            raise StmtSyntaxError("Missing time period after '%s'" % self._width)
+
     def add(self, token, symbol):
+        if token == TOKEN_NUMBER:
+            if self._width is not None or not isinstance(symbol, (int, long)) or symbol < 1:
+                raise StmtSyntaxError("Invalid time period width '%s'" % symbol)
+            self._width = symbol
+            return
+
         symbol = symbol.lower()
         if token == TOKEN_COMMA or (token == TOKEN_KEYWORD and symbol == 'by'):
             return
 
         xsymbol = _strip_plural(symbol)
+        if self._width is not None and xsymbol not in self.TIME_GROUPS:
+            raise StmtSyntaxError("Invalid time period '%s'" % symbol)
+
         if xsymbol == 'key':
             self.keys.append('__key__')
         elif xsymbol in self.TIME_GROUPS:
-            if self.time_period is not None and xsymbol != self.time_period:
+            width = self._width or 1
+            if self.time_period is not None and (xsymbol, width) != (self.time_period, self.time_width):
                 raise StmtSyntaxError("Another time period already specified '%s'" % self.time_period)
             self.time_period = xsymbol
+            self.time_width = width
+            self._width = None
             self.keys.append('__ts__')
         else:
             self.keys.append(symbol)
@@ -344,6 +401,16 @@ class StmtStore(Stmt):
             self._current_function = StmtFunction()
             self._result_name = None
 
+    def uses_window(self):
+        """
+        Returns True if a window function (e.g. rate) needs the row timestamp.
+        """
+        for func in self.results.itervalues():
+            for symbol in functions.function_symbols(func.content):
+                if _FUNCTIONS_MAP[symbol].WINDOW:
+                    return True
+        return False
+
     def functions(self):
         for key, func in self.results.iteritems():
             yield key, functions.Executor(_FUNCTIONS_MAP, func.content)
@@ -351,6 +418,56 @@ class StmtStore(Stmt):
     def __repr__(self):
         return 'Store %r' % self.results
 
+class StmtOrderBy(Stmt):
+    """
+    ORDER BY avg(ms) DESC
+    ORDER BY key
+    """
+    def __init__(self):
+        self.descending = False
+        self.name = None
+        self._expr = StmtFunction()
+
+    def close(self):
+        if self._expr.is_null():
+            raise StmtSyntaxError("Missing 'ORDER BY' expression.")
+        self._expr.close()
+        self.name = str(self._expr)
+
+    def add(self, token, symbol):
+        if token == TOKEN_KEYWORD:
+            xsymbol = symbol.lower()
+            if xsymbol == 'by' and self._expr.is_null():
+                return
+            if xsymbol in ('asc', 'desc'):
+                self.descending = (xsymbol == 'desc')
+                return
+        self._expr.add(token, symbol)
+
+    def __repr__(self):
+        return 'Order By %r%s' % (self.name, ' Desc' if self.descending else '')
+
+class StmtLimit(Stmt):
+    """
+    LIMIT 10
+    """
+    def __init__(self):
+        self.count = None
+
+    def close(self):
+        if self.count is None:
+            raise StmtSyntaxError("Missing 'LIMIT' count.")
+
+    def add(self, token, symbol):
+        if token != TOKEN_NUMBER or self.count is not None:
+            raise StmtSyntaxError("Invalid limit '%s'" % symbol)
+        if not isinstance(symbol, (int, long)) or symbol < 1:
+            raise StmtSyntaxError("Invalid limit '%s'" % symbol)
+        self.count = symbol
+
+    def __repr__(self):
+        return 'Limit %r' % self.count
+
 class Query(object):
     STMT_TOKENS = {
         'from': StmtFrom,
@@ -359,6 +476,8 @@ class Query(object):
         'split': StmtSplit,
         'where': StmtWhere,
         'store': StmtStore,
+        'order': StmtOrderBy,
+        'limit': StmtLimit,
     }
 
     def __init__(self):
@@ -368,6 +487,8 @@ class Query(object):
         self.stmt_split = None
         self.stmt_where = None
         self.stmt_store = None
+        self.stmt_order = None
+        self.stmt_limit = None
 
     def __iter__(self):
         yield self.stmt_from
@@ -376,6 +497,29 @@ class Query(object):
         if self.stmt_split is not None: yield self.stmt_split
         if self.stmt_where is not None: yield self.stmt_where
         if self.stmt_store is not None: yield self.stmt_store
+        if self.stmt_order is not None: yield self.stmt_order
+        if self.stmt_limit is not None: yield self.stmt_limit
+
+    def order_by(self):
+        """
+        Returns the ('store', name) of a STORE result (e.g. avg(ms) or its
+        alias) or the ('group', key) of a GROUP BY key to order by.
+        """
+        name = self.stmt_order.name
+        if self.stmt_store is not None and name in self.stmt_store.results:
+            return 'store', name
+
+        xname = _strip_plural(name.lower())
+        if xname == 'key':
+            xname = '__key__'
+        elif xname in StmtGroupBy.TIME_GROUPS:
+            xname = '__ts__'
+        else:
+            xname = name
+        if self.stmt_group is not None and xname in self.stmt_group.keys:
+            return 'group', xname
+
+        raise StmtSyntaxError("Unknown ORDER BY '%s', not a STORE result or a group." % name)
 
     @classmethod
     def parse(cls, query):
@@ -414,6 +558,9 @@ class Query(object):
             if query_obj.stmt_store is not None:
                 raise StmtSyntaxError("You need to specify SPLIT to STORE something.")
 
+        if query_obj.stmt_order is not None:
+            query_obj.order_by()
+
         # TODO: Check Store func args with Split vars
         return query_obj
 
@@ -435,4 +582,5 @@ if __name__ == '__main__':
     dump_stmts("FROM KEYS k, l SPLIT a, b WHERE a > 20 AND b > (18 + 21 * (54 - 10))")
     dump_stmts("FROM KEYS k, l SPLIT a, b WHERE a b c")
     dump_stmts("FROM FILES 'test/a.txt' as ka, 'test/a2.txt' as ka 'test/b.txt' as b SPLIT a, b STORE min(b + 20 + 1) as b")
+    dump_stmts("FROM TSFILES 'ping-.*' GROUP BY key SPLIT ms STORE max(ms) ORDER BY max(ms) DESC LIMIT 10")
 
@@ -25,6 +25,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from skvoz.aggregation.tdql.compiler import compile_rpn
 from skvoz.aggregation.tdql.tokenizer import *
 
 def _rpn_binary_evaluate(operation, operand_left, operand_right, context=None):
@@ -160,7 +161,34 @@ class RpnEvaluator(object):
         return self.evaluate(items)
 
 class RpnBooleanEvaluator(RpnEvaluator):
+    """
+    Evaluate the rpn on the row items, returning True if the row must
+    be discarded. The expression is compiled, rows where the compiled
+    expression fails are evaluated again by the interpreter.
+    """
+    def __init__(self, rpn, context=None):
+        super(RpnBooleanEvaluator, self).__init__(rpn, context)
+        self._compile()
+
+    def _compile(self):
+        self._expr = compile_rpn(self.rpn) if self.context is None else None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_expr']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
     def __call__(self, items):
+        if self._expr is not None:
+            try:
+                return not self._expr(items)
+            except Exception:
+                pass
+
         r = self.evaluate(items)
         if len(r) != 1 or isinstance(r[0], basestring):
             q = rpn_to_infix_string(self.rpn)
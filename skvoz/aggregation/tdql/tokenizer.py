@@ -25,7 +25,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from cStringIO import StringIO
+import re
 
 SYMBOLS_QUOTE = ('"', "'")
 SYMBOLS_SPACE = ' \t\r\n'
@@ -49,16 +49,16 @@ TOKEN_SYMBOLS_TABLE = {
     TOKEN_OPERATOR: '+-*/%',
 }
 
-def _sdata_to_token(sdata):
-    if not sdata:
-        return None
+_NUMBER_FIRST_CHARS = frozenset('0123456789.')
+_FLOAT_WORDS = frozenset(('nan', 'inf', 'infinity'))
 
-    token = ''.join(sdata)
-    for t in (int, float):
-        try:
-            return TOKEN_NUMBER, t(token)
-        except ValueError:
-            pass
+def _word_to_token(token):
+    if token[0] in _NUMBER_FIRST_CHARS or token.lower() in _FLOAT_WORDS:
+        for t in (int, float):
+            try:
+                return TOKEN_NUMBER, t(token)
+            except ValueError:
+                pass
 
     utoken = token.upper()
     if utoken == 'TRUE':
@@ -69,63 +69,48 @@ def _sdata_to_token(sdata):
         return TOKEN_OPERATOR, utoken
     return TOKEN_KEYWORD, token
 
-def tokenize(query):
-    if isinstance(query, basestring):
-        query = StringIO(query)
-
-    quoted = None
-    sdata = []
-
-    while True:
-        c = query.read(1)
-        if not c: break
-
-        if quoted:
-            if c == quoted:
-                yield TOKEN_STRING, ''.join(sdata)
-                sdata = []
-                quoted = None
-            else:
-                if c == '\\':
-                    c = query.read(1)
-                    if not c: break
-                sdata.append(c)
-            continue
-
-        if c in SYMBOLS_QUOTE:
-            quoted = c
-            continue
-
-        for sym_token, sym in TOKEN_SYMBOLS_TABLE.iteritems():
-            if c in sym:
-                stoken = _sdata_to_token(sdata)
-                sdata = []
-                if stoken is not None: yield stoken
-                if sym_token is not None: yield sym_token, c
-                break
-        else:
-            if c in '><=!':
-                stoken = _sdata_to_token(sdata)
-                sdata = []
-                if stoken is not None: yield stoken
-
-                nc = query.read(1)
-                if not c:break
-
-                if nc == '=':
-                    yield TOKEN_OPERATOR, c + nc
-                elif (c == '<' and nc in '<') or (c == '>' and nc == '>'):
-                    yield TOKEN_OPERATOR, c + nc
-                else:
-                    if c in '=!': c += '='
-                    yield TOKEN_OPERATOR, c
-                    if nc not in SYMBOLS_SPACE:
-                        sdata.append(nc)
-            else:
-                sdata.append(c)
+# Single pass scanner, each match is one token (or spaces to skip)
+RX_TOKEN = re.compile(r"""
+    (?P<space>[ \t\r\n]+) |
+    (?P<string>(?P<quote>['"])(?P<sdata>(?:\\.|(?!(?P=quote)).)*)(?P=quote)) |
+    (?P<compare>[<>]=|==|!=|<<|>>|[<>=!]) |
+    (?P<symbol>[(),+\-*/%]) |
+    (?P<word>[^ \t\r\n'"(),+\-*/%<>=!]+)
+""", re.VERBOSE | re.DOTALL)
+
+RX_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+_SYMBOL_TOKENS = {
+    '(': TOKEN_PARENTHESES_OPEN,
+    ')': TOKEN_PARENTHESES_CLOSE,
+    ',': TOKEN_COMMA,
+}
 
-    if quoted:
-        raise Exception("Missing end quote")
+_COMPARE_ALIASES = {'=': '==', '!': '!='}
 
-    stoken = _sdata_to_token(sdata)
-    if stoken is not None: yield stoken
+def tokenize(query):
+    if not isinstance(query, basestring):
+        query = query.read()
+
+    match = RX_TOKEN.match
+    pos = 0
+    length = len(query)
+    while pos < length:
+        m = match(query, pos)
+        if m is None:
+            if query[pos] in SYMBOLS_QUOTE:
+                raise Exception("Missing end quote")
+            raise Exception("Invalid symbol '%s'" % query[pos])
+        pos = m.end()
+
+        kind = m.lastgroup
+        if kind == 'word':
+            yield _word_to_token(m.group(kind))
+        elif kind == 'symbol':
+            c = m.group(kind)
+            yield _SYMBOL_TOKENS.get(c, TOKEN_OPERATOR), c
+        elif kind == 'compare':
+            c = m.group(kind)
+            yield TOKEN_OPERATOR, _COMPARE_ALIASES.get(c, c)
+        elif kind == 'string':
+            yield TOKEN_STRING, RX_ESCAPE.sub(r'\1', m.group('sdata'))
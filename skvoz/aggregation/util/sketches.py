@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+Constant memory, mergeable summaries of a stream of values.
+
+    DDSketch        quantiles with a bounded relative error
+    HyperLogLog     number of distinct values
+    CountMinTopK    most frequent values
+
+All of them support merge() of a sketch with the same parameters,
+built on a different set of values.
+"""
+
+from hashlib import md5
+from array import array
+
+import struct
+import math
+
+def hash64(value):
+    """
+    64bit hash of the bytes of the value (the string itself or its repr).
+    Unlike hash(), floats and small ints don't collide, and the result
+    does not depend on the process hash randomization.
+    """
+    if isinstance(value, unicode):
+        data = 's' + value.encode('utf-8')
+    elif isinstance(value, str):
+        data = 's' + value
+    else:
+        data = 'r' + repr(value)
+    return struct.unpack('<Q', md5(data).digest()[:8])[0]
+
+class DDSketch(object):
+    """
+    Quantile sketch with relative accuracy: the value returned for a
+    quantile is within 'accuracy' (relative) of the exact one.
+    Values are counted in logarithmic buckets, when there are more than
+    max_buckets the lowest ones are collapsed.
+    """
+    def __init__(self, accuracy=0.01, max_buckets=2048):
+        self.accuracy = accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zeros = 0
+        self.count = 0
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        return 2.0 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value):
+        if value > 0:
+            buckets = self.positive
+            index = self._index(value)
+        elif value < 0:
+            buckets = self.negative
+            index = self._index(-value)
+        else:
+            self.zeros += 1
+            self.count += 1
+            return
+
+        buckets[index] = buckets.get(index, 0) + 1
+        self.count += 1
+        if len(buckets) > self.max_buckets:
+            self._collapse(buckets)
+
+    def _collapse(self, buckets):
+        indexes = sorted(buckets)
+        extra = len(indexes) - self.max_buckets
+        lowest = indexes[extra]
+        for index in indexes[:extra]:
+            buckets[lowest] += buckets.pop(index)
+
+    def merge(self, other):
+        for buckets, other_buckets in ((self.positive, other.positive),
+                                       (self.negative, other.negative)):
+            for index, count in other_buckets.iteritems():
+                buckets[index] = buckets.get(index, 0) + count
+            if len(buckets) > self.max_buckets:
+                self._collapse(buckets)
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        """
+        Returns the value of the quantile q (0 <= q <= 1),
+        or None if the sketch is empty.
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+
+        seen += self.zeros
+        if seen > rank:
+            return 0
+
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.positive))
+
+class HyperLogLog(object):
+    """
+    Distinct count estimate, with 2^precision registers of one byte
+    (standard error 1.04 / sqrt(2^precision), 1.6% with the default).
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        x = hash64(value)
+        p = self.precision
+        index = x >> (64 - p)
+        rho = (64 - p) - (x & ((1 << (64 - p)) - 1)).bit_length() + 1
+        if rho > self.registers[index]:
+            self.registers[index] = rho
+
+    def merge(self, other):
+        registers = self.registers
+        for i, rho in enumerate(other.registers):
+            if rho > registers[i]:
+                registers[i] = rho
+
+    def cardinality(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+
+        # Small range correction
+        zeros = self.registers.count('\0')
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+class CountMinTopK(object):
+    """
+    Most frequent values: a Count-Min sketch (depth x width counters)
+    estimates the frequency of every value, and the 'capacity' values
+    with the highest estimates are kept as candidates.
+    """
+    def __init__(self, capacity=64, width=512, depth=4):
+        self.capacity = capacity
+        self.width = width
+        self.depth = depth
+        self.counters = [array('L', [0]) * width for _ in xrange(depth)]
+        self.candidates = {}
+        self._min_candidate = 0
+
+    def _indexes(self, value):
+        x = hash64(value)
+        h1 = x & 0xffffffff
+        h2 = x >> 32
+        width = self.width
+        return [(h1 + i * h2) % width for i in xrange(self.depth)]
+
+    def _estimate(self, indexes):
+        return min(row[i] for row, i in zip(self.counters, indexes))
+
+    def add(self, value):
+        indexes = self._indexes(value)
+        for row, i in zip(self.counters, indexes):
+            row[i] += 1
+        estimate = self._estimate(indexes)
+
+        candidates = self.candidates
+        if value in candidates:
+            candidates[value] = estimate
+        elif len(candidates) < self.capacity:
+            candidates[value] = estimate
+            self._min_candidate = min(candidates.itervalues())
+        elif estimate > self._min_candidate:
+            # The estimates grow, refresh the minimum before replacing it
+            lowest = min(candidates, key=candidates.get)
+            if estimate > candidates[lowest]:
+                del candidates[lowest]
+                candidates[value] = estimate
+            self._min_candidate = min(candidates.itervalues())
+
+    def merge(self, other):
+        for row, other_row in zip(self.counters, other.counters):
+            for i, count in enumerate(other_row):
+                if count:
+                    row[i] += count
+
+        values = set(self.candidates) | set(other.candidates)
+        estimates = [(self._estimate(self._indexes(v)), v) for v in values]
+        estimates.sort(reverse=True)
+        self.candidates = dict((v, e) for e, v in estimates[:self.capacity])
+        self._min_candidate = min(self.candidates.itervalues()) if self.candidates else 0
+
+    def top(self, n):
+        """
+        Returns the n most frequent [value, count] (estimated).
+        """
+        top = sorted(self.candidates.iteritems(), key=lambda x: (-x[1], x[0]))
+        return [[v, c] for v, c in top[:n]]
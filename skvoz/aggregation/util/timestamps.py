@@ -26,88 +26,180 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from datetime import datetime, timedelta
+from time import gmtime, localtime, mktime, strftime
+from calendar import timegm
+from itertools import groupby
+
+import math
+
+_DAY_SECONDS = 86400
+_WEEK_SECONDS = 7 * _DAY_SECONDS
+# 1970-01-05 is the first monday after the epoch
+_EPOCH_MONDAY = 4 * _DAY_SECONDS
+
+def _utc_offset(timestamp):
+    return timegm(localtime(timestamp)) - int(timestamp)
+
+def _year_start(year):
+    return timegm((year, 1, 1, 0, 0, 0))
+
+def _month_start(index):
+    return timegm((index // 12, (index % 12) + 1, 1, 0, 0, 0))
+
+class TimeBucket(object):
+    """
+    Assign the timestamps to local time periods of the specified width
+    (e.g. 5 minutes), computing the period boundaries once per period
+    with integer arithmetic on the local epoch. The period key is the
+    formatted start of the period.
+
+        bucket = TimeBucket('minute', 5)
+        for ts, data in tsdata:
+            key = bucket(ts)
+    """
+    FORMATS = {
+        'second': '%Y-%m-%d-%H.%M.%S',
+        'minute': '%Y-%m-%d-%H.%M',
+        'hour':   '%Y-%m-%d-%H',
+        'day':    '%Y-%m-%d',
+        'week':   '%Y-%W',
+        'month':  '%Y-%m',
+        'year':   None,
+    }
+
+    WIDTHS = {
+        'second': 1,
+        'minute': 60,
+        'hour':   3600,
+        'day':    _DAY_SECONDS,
+    }
+
+    def __init__(self, period, count=1):
+        if period not in self.FORMATS:
+            raise ValueError("Invalid period '%s'" % period)
+        if count < 1:
+            raise ValueError("Invalid period width %r" % count)
+
+        self.period = period
+        self.count = int(count)
+        self.key = self.start = self.end = None
+
+    def __call__(self, timestamp):
+        if self.end is None or not (self.start <= timestamp < self.end):
+            self.key, self.start, self.end = self.range(timestamp)
+        return self.key
+
+    def range(self, timestamp):
+        """
+        Returns the key of the period that contains the timestamp,
+        and the (start, end) timestamps of the period.
+            key, start, end = bucket.range(ts)
+        """
+        offset = _utc_offset(timestamp)
+        local = int(math.floor(timestamp)) + offset
+
+        start, end = self._local_range(local)
+
+        if self.period == 'year':
+            key = gmtime(start).tm_year
+        else:
+            key = strftime(self.FORMATS[self.period], gmtime(start))
+
+        # The offset may change inside the period (DST)
+        start -= _utc_offset(start - offset)
+        end -= _utc_offset(end - offset)
+        return key, start, end
+
+    def _local_range(self, local):
+        period = self.period
+        count = self.count
+
+        width = self.WIDTHS.get(period)
+        if width is not None:
+            width *= count
+            start = local - (local % width)
+            return start, start + width
+
+        year = gmtime(local).tm_year
+        if period == 'year':
+            year -= (year % count)
+            return _year_start(year), _year_start(year + count)
+
+        if period == 'month':
+            tm = gmtime(local)
+            index = (tm.tm_year * 12) + (tm.tm_mon - 1)
+            index -= (index % count)
+            return _month_start(index), _month_start(index + count)
+
+        # '%Y-%W' changes on monday and on the first day of the year
+        assert period == 'week'
+        day = local - (local % _DAY_SECONDS)
+        monday = day - (((day - _EPOCH_MONDAY) // _DAY_SECONDS) % 7) * _DAY_SECONDS
+        monday -= (((monday - _EPOCH_MONDAY) // _WEEK_SECONDS) % count) * _WEEK_SECONDS
+        start = max(monday, _year_start(year))
+        end = min(monday + (count * _WEEK_SECONDS), _year_start(year + 1))
+        return start, end
 
 # Date Grouping Functions
 # for date_key, data in group_by_day(tsdata):
 #     for timestamp, record in data:
 #         ...
-class _group_by_date(object):
-    # [k for k, g in groupby('AAAABBBCCDAABBB')] --> A B C D A B
-    # [list(g) for k, g in groupby('AAAABBBCCD')] --> AAAA BBB CC D
-    def __init__(self, tsdata, key, date=None):
-        self.datefunc = lambda d: d if date is None else date
-        self.keyfunc = key
-        self.it = iter(tsdata)
-        self.tgtkey = self.currkey = self.currdate = self.currvalue = object()
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        while self.currkey == self.tgtkey:
-            self._next_key()
-        self.tgtkey = self.currkey
-        return (self.currkey, self._grouper(self.tgtkey))
-
-    def _grouper(self, tgtkey):
-        while self.currkey == tgtkey:
-            yield self.currvalue
-            self._next_key()
-
-    def _next_key(self):
-        self.currvalue = next(self.it)    # Exit on StopIteration
-        timestamp = datetime.fromtimestamp(self.currvalue[0])
-        self.currkey = self.keyfunc(timestamp)
-        self.currdate = self.datefunc(timestamp)
+def group_by_period(tsdata, period, count=1):
+    bucket = TimeBucket(period, count)
+    return groupby(tsdata, lambda row: bucket(row[0]))
+
+def group_by_second(tsdata):
+    return group_by_period(tsdata, 'second')
 
 def group_by_minute(tsdata):
-    date_key = lambda d: d.strftime('%Y-%m-%d-%H.%M')
-    return _group_by_date(tsdata, date_key)
+    return group_by_period(tsdata, 'minute')
 
 def group_by_hour(tsdata):
-    date_key = lambda d: d.strftime('%Y-%m-%d-%H')
-    return _group_by_date(tsdata, date_key)
+    return group_by_period(tsdata, 'hour')
 
 def group_by_day(tsdata):
-    date_key = lambda d: d.strftime('%Y-%m-%d')
-    return _group_by_date(tsdata, date_key)
+    return group_by_period(tsdata, 'day')
 
 def group_by_week(tsdata):
-    date_key = lambda d: d.strftime('%Y-%W')
-    return _group_by_date(tsdata, date_key)
+    return group_by_period(tsdata, 'week')
 
 def group_by_month(tsdata):
-    date_key = lambda d: d.strftime('%Y-%m')
-    return _group_by_date(tsdata, date_key)
+    return group_by_period(tsdata, 'month')
 
 def group_by_year(tsdata):
-    date_key = lambda d: d.year
-    return _group_by_date(tsdata, date_key)
+    return group_by_period(tsdata, 'year')
+
+def date_to_epoch(d):
+    return mktime(d.timetuple()) + (d.microsecond / 1000000.0)
 
 # Date Filter Functions
-def _filter_by_date(tsdata, keep_date_func):
-    for ts, data in tsdata:
-        if keep_date_func(datetime.fromtimestamp(ts)):
-            yield ts, data
+def _filter_by_time(tsdata, start, end=None):
+    """
+    Keep the rows with start <= timestamp < end
+    """
+    if end is None:
+        for row in tsdata:
+            if row[0] >= start:
+                yield row
+    else:
+        for row in tsdata:
+            if start <= row[0] < end:
+                yield row
 
 def filter_by_timeref(tsdata, tref):
     tref = datetime(tref.year, tref.month, tref.day, tref.hour, tref.minute)
-    keep_func = lambda d, tref=tref: d >= tref
-    return _filter_by_date(tsdata, keep_func)
+    return _filter_by_time(tsdata, date_to_epoch(tref))
 
 def filter_by_last_years(tsdata, n):
-    tref = datetime.today().year - n
-    keep_func = lambda d, tref=tref: d.year >= tref
-    return _filter_by_date(tsdata, keep_func)
+    tref = datetime(datetime.today().year - n, 1, 1)
+    return _filter_by_time(tsdata, date_to_epoch(tref))
 
 def filter_by_last_months(tsdata, n):
     today = datetime.today()
     first_of_month = today - timedelta(days=(today.day - 1))
     tref = first_of_month - timedelta(days=(30 * (n - 1)))
     tref = datetime(tref.year, tref.month, 1)
-
-    keep_func = lambda d, tref=tref: d >= tref
-    return _filter_by_date(tsdata, keep_func)
+    return _filter_by_time(tsdata, date_to_epoch(tref))
 
 def filter_by_last_weeks(tsdata, n):
     today = datetime.today()
@@ -131,18 +223,14 @@ def filter_by_last_minutes(tsdata, n):
     return filter_by_timeref(tsdata, tref)
 
 def filter_by_year(tsdata, yfrom, yto):
-    if yfrom is not None and yto is None:
-        keep_func = lambda d: d.year >= yfrom
-    elif yfrom is None and yto is not None:
-        keep_func = lambda d: d.year <= yto
-    else:
-        assert yfrom is not None and yto is not None
-        keep_func = lambda d: yfrom <= d.yfrom <= yto
-    return _filter_by_date(tsdata, keep_func)
+    start = float('-inf') if yfrom is None else date_to_epoch(datetime(yfrom, 1, 1))
+    end = None if yto is None else date_to_epoch(datetime(yto + 1, 1, 1))
+    return _filter_by_time(tsdata, start, end)
 
 def filter_by_interval(tsdata, tstart, tend=None):
+    start = date_to_epoch(tstart)
     if tend is None:
-        keep_func = lambda d, tstart=tstart: d >= tstart
-    else:
-        keep_func = lambda d, tstart=tstart, tend=tend: tstart <= d <= tend
-    return _filter_by_date(tsdata, keep_func)
+        return _filter_by_time(tsdata, start)
+
+    end = date_to_epoch(tend)
+    return (row for row in tsdata if start <= row[0] <= end)
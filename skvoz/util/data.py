@@ -25,10 +25,23 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from json import dumps as json_dumps, loads as json_loads
 from itertools import izip
+from array import array
 
+import struct
+import sys
 import re
 
+# Binary columnar encoding of a DataTable (see DataTable.toBinary())
+COLUMNS_MIME = 'application/x-skvoz-columns'
+COLUMNS_MAGIC = 'SKVC1'
+
 def string_to_type(sdata):
     if not isinstance(sdata, basestring):
         return sdata
@@ -45,14 +58,119 @@ def string_to_type(sdata):
 
     return sdata
 
+def _parse_bool(sdata):
+    ldata = sdata.strip().lower()
+    if ldata == 'true': return True
+    if ldata == 'false': return False
+    raise ValueError("invalid boolean %r" % sdata)
+
+# Characters that can't be in an integer, and the first characters of
+# the strings that string_to_type() may convert
+RX_NOT_INTEGER = re.compile('[.eEnN]')
+_TYPED_FIRST_CHARS = frozenset('0123456789+-. \t\r\n\x0b\x0cnNiItTfF')
+
+def _auto_int(sdata):
+    try:
+        return int(sdata)
+    except ValueError:
+        return string_to_type(sdata)
+
+def _auto_float(sdata):
+    if RX_NOT_INTEGER.search(sdata):
+        try:
+            return float(sdata)
+        except ValueError:
+            pass
+    return string_to_type(sdata)
+
+def _auto_str(sdata):
+    if sdata[:1] in _TYPED_FIRST_CHARS:
+        return string_to_type(sdata)
+    return sdata
+
+def _infer_converter(sdata):
+    """
+    Returns a converter with the same results of string_to_type(),
+    but faster on the values of the same type of sdata.
+    """
+    vtype = type(string_to_type(sdata))
+    if vtype is int: return _auto_int
+    if vtype is float: return _auto_float
+    return _auto_str
+
+# SPLIT name:type, None is the raw string
+SPLIT_TYPES = {
+    'str': None,
+    'int': int,
+    'float': float,
+    'bool': _parse_bool,
+}
+
+_CHECK_SYMBOLS = ('<', '<=', '>', '>=', '==', '!=')
+
+def _compile_converter(varnames, converters, checks=()):
+    """
+    Returns a function building the items dict from the list of splits:
+        def convert(s):
+            return {'a': c0(s[0]), 'b': s[1]}
+    or None if one of the checks (index, symbol, value) fails:
+        def convert(s):
+            x0 = c0(s[0])
+            if not (x0 > v0): return None
+            return {'a': x0, 'b': s[1]}
+    """
+    lines = []
+    fields = {}
+    for i, (index, symbol, value) in enumerate(checks):
+        if symbol not in _CHECK_SYMBOLS:
+            raise Exception("Invalid check symbol '%s'" % symbol)
+        if index not in fields:
+            fields[index] = 'x%d' % index
+            if converters[index] is None:
+                lines.append('x%d = s[%d]' % (index, index))
+            else:
+                lines.append('x%d = c%d(s[%d])' % (index, index, index))
+        lines.append('if not (x%d %s v%d): return None' % (index, symbol, i))
+
+    items = []
+    for i, (name, converter) in enumerate(zip(varnames, converters)):
+        if i in fields:
+            items.append('%r: %s' % (name, fields[i]))
+        elif converter is None:
+            items.append('%r: s[%d]' % (name, i))
+        else:
+            items.append('%r: c%d(s[%d])' % (name, i, i))
+    lines.append('return {%s}' % ', '.join(items))
+
+    args = ''.join('c%d, ' % i for i in xrange(len(converters)))
+    args += ''.join('v%d, ' % i for i in xrange(len(checks)))
+    source = 'def _make(%s):\n' \
+             '    def convert(s):\n' \
+             '%s' \
+             '    return convert\n' % (args, ''.join('        %s\n' % line for line in lines))
+    namespace = {}
+    exec source in namespace
+    return namespace['_make'](*(list(converters) + [value for _, _, value in checks]))
+
 class DataSplitter(object):
     """
     Split ['a', 'b', 'c'] On [':', ',']
     Split ['a', 'b'] On ['\w+]
+
+    The types are the SPLIT_TYPES names declared for each var, or None
+    to convert as string_to_type() does. The converters of the undeclared
+    vars are picked looking at the first row.
     """
-    def __init__(self, varnames, delimiters=None):
+    def __init__(self, varnames, delimiters=None, types=None):
         self.varnames = varnames
         self.delimiters = delimiters
+        self.types = list(types or [None] * len(varnames))
+        self._convert = None
+        self._converters = None
+
+        for vtype in self.types:
+            if vtype is not None and vtype not in SPLIT_TYPES:
+                raise Exception("Invalid split type '%s'" % vtype)
 
         if delimiters is None:
             self._rxsplit = None
@@ -62,6 +180,40 @@ class DataSplitter(object):
             pattern = '|'.join(map(re.escape, delimiters))
             self._rxsplit = re.compile(pattern)
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_convert'] = None
+        state['_converters'] = None
+        return state
+
+    def split(self, data):
+        """
+        Returns the list of raw (string) values of the data.
+        """
+        if self._rxsplit is None:
+            return data.split(' ', len(self.varnames) - 1)
+        return self._rxsplit.split(data, len(self.varnames) - 1)
+
+    def compile_filter(self, splits, checks):
+        """
+        Returns a function converting the splits, as convert() does, but
+        returning None if one of the checks (index, symbol, value) fails.
+        The converters not declared are inferred from splits if needed.
+        """
+        if self._convert is None:
+            self._compile(splits)
+        return _compile_converter(self.varnames, self._converters, checks)
+
+    def _compile(self, splits):
+        converters = []
+        for vtype, sdata in izip(self.types, splits):
+            if vtype is None:
+                converters.append(_infer_converter(sdata))
+            else:
+                converters.append(SPLIT_TYPES[vtype])
+        self._convert = _compile_converter(self.varnames, converters)
+        self._converters = converters
+
     def __call__(self, data):
         varnames = self.varnames
         rxsplit = self._rxsplit
@@ -73,21 +225,130 @@ class DataSplitter(object):
 
         if len(splits) != len(varnames):
             raise Exception("Number of splits %r don't match with vars %r" % (splits, varnames))
+        return self.convert(splits, data)
 
-        results = {}
-        for key, value in izip(varnames, splits):
-            results[key] = string_to_type(value)
-        return results
+    def convert(self, splits, data):
+        """
+        Returns the dict of the raw values returned by split(data),
+        converted to their types.
+        """
+        if self._convert is None:
+            self._compile(splits)
+        try:
+            return self._convert(splits)
+        except ValueError, e:
+            raise Exception("Invalid value in %r for the split types %r: %s" % (data, self.types, e))
+
+class Column(object):
+    """
+    The values of a table column, stored as an array('l') while they are
+    all integers, as an array('d') while they are all floats, or as a list
+    (of interned strings) as soon as something else is added. Mixed ints
+    and floats are kept in a list, so they come back exactly as added.
+    """
+    def __init__(self, values=()):
+        self.values = array('l')
+        self.extend(values)
+
+    def append(self, value):
+        vtype = type(value)
+        typecode = getattr(self.values, 'typecode', None)
+        if typecode == 'l':
+            if vtype is int:
+                self.values.append(value)
+                return
+            if vtype is float and not self.values:
+                self.values = array('d')
+                self.values.append(value)
+                return
+            self.values = list(self.values)
+        elif typecode == 'd':
+            if vtype is float:
+                self.values.append(value)
+                return
+            self.values = list(self.values)
+
+        if vtype is str:
+            value = intern(value)
+        self.values.append(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def take(self, indexes):
+        """
+        Returns a new column with the values at the specified indexes.
+        """
+        values = self.values
+        column = Column()
+        if isinstance(values, array):
+            column.values = array(values.typecode, [values[i] for i in indexes])
+        else:
+            column.values = [values[i] for i in indexes]
+        return column
+
+    def is_numeric(self):
+        return isinstance(self.values, array)
+
+    def asarray(self):
+        """
+        Returns a numpy view of a numeric column, sharing its memory.
+        """
+        if numpy is None:
+            raise Exception("numpy is not available")
+        if not self.is_numeric():
+            raise Exception("The column is not numeric")
+        return numpy.frombuffer(self.values, dtype=self.values.typecode)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+def flatten_result(result):
+    """
+    Turn a (groups, results) of the aggregator in a single row dict, the
+    group keys prefix the names of the result values. The time period
+    is kept as the '__ts__' column.
+    """
+    if isinstance(result, dict):
+        data = dict(result)
+    else:
+        data = {}
+        keys, gdata = result
+        keys = dict(keys or {})
+        if '__ts__' in keys:
+            data['__ts__'] = keys.pop('__ts__')
+        keys = ''.join(keys)
+        for kdata in gdata:
+            for k, v in kdata.iteritems():
+                data['%s%s' % (keys, k)] = v
+
+    data.pop('__key__', None)
+    return data
 
 class DataTable(object):
+    """
+    Columnar table of the rows fetched from the aggregator.
+    """
     def __init__(self):
         self.columns = []
-        self.rows = []
+        self.data = []
+
+    @property
+    def rows(self):
+        return [list(row) for row in izip(*self.data)]
 
     def addColumn(self, name):
-        if len(self.rows) > 0:
+        if len(self.data) > 0 and len(self.data[0]) > 0:
             raise Exception("You've already added rows!")
         self.columns.append(name)
+        self.data.append(Column())
 
     def addColumns(self, *args):
         for column in args:
@@ -96,29 +357,29 @@ class DataTable(object):
     def addRow(self, row):
         if isinstance(row, dict):
             if len(self.columns) == 0:
-                self.columns.extend(sorted(row.keys()))
-
-            irow = [None] * len(self.columns)
-            for col, value in row.iteritems():
-                index = self.columns.index(col)
-                if index >= 0:
-                    irow[index] = value
-            row = irow
-        self.rows.append(row)
+                self.addColumns(*sorted(row.keys()))
+            # Values of unknown columns are dropped
+            row = [row.get(col) for col in self.columns]
+        for column, value in izip(self.data, row):
+            column.append(value)
 
     def addRows(self, rows):
         for row in rows:
             self.addRow(row)
 
     def clearRows(self):
-        self.rows = []
+        self.data = [Column() for _ in self.columns]
 
-    def columnRows(self, column):
+    def column(self, column):
+        """
+        Returns the Column object, without copying the values.
+        """
         if isinstance(column, basestring):
             column = self.columns.index(column)
+        return self.data[column]
 
-        for row in self.rows:
-            yield row[column]
+    def columnRows(self, column):
+        return iter(self.column(column))
 
     def show(self):
         lencols = [max(len(str(row)) for row in self.columnRows(i))
@@ -136,3 +397,68 @@ class DataTable(object):
         for row in self.rows:
             print '|%s|' % '|'.join([rfrmt.format(c, w=w) for c, w in zip(row, lencols)])
         print separator
+
+    def toBinary(self):
+        """
+        Encode the table as length-prefixed column blocks:
+            'SKVC1' ncolumns:u32 nrows:u32
+            per column: name_len:u16 name type:char data_len:u32 data
+        Numeric columns are the little endian int64 ('l') or float64 ('d')
+        values, the others a JSON list ('j').
+        """
+        nrows = len(self.data[0]) if self.data else 0
+        blocks = [COLUMNS_MAGIC, struct.pack('<II', len(self.columns), nrows)]
+        for name, column in izip(self.columns, self.data):
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            values = column.values
+            if isinstance(values, array) and values.itemsize == 8:
+                if sys.byteorder == 'big':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                vtype, payload = values.typecode, values.tostring()
+            else:
+                vtype, payload = 'j', json_dumps(list(values))
+            blocks.append(struct.pack('<H', len(name)))
+            blocks.append(name)
+            blocks.append(vtype)
+            blocks.append(struct.pack('<I', len(payload)))
+            blocks.append(payload)
+        return ''.join(blocks)
+
+    @classmethod
+    def fromBinary(cls, data):
+        """
+        Decode a table encoded by toBinary(), a column at a time.
+        """
+        if not data.startswith(COLUMNS_MAGIC):
+            raise Exception("Invalid columns data")
+        offset = len(COLUMNS_MAGIC)
+        ncolumns, nrows = struct.unpack_from('<II', data, offset)
+        offset += 8
+
+        table = cls()
+        for _ in xrange(ncolumns):
+            nlen, = struct.unpack_from('<H', data, offset)
+            offset += 2
+            name = data[offset:offset+nlen].decode('utf-8')
+            vtype = data[offset+nlen]
+            plen, = struct.unpack_from('<I', data, offset + nlen + 1)
+            offset += nlen + 5
+            payload = data[offset:offset+plen]
+            offset += plen
+
+            column = Column()
+            if vtype == 'j':
+                column.values = json_loads(payload)
+            else:
+                column.values = array(vtype)
+                column.values.fromstring(payload)
+                if sys.byteorder == 'big':
+                    column.values.byteswap()
+            if len(column) != nrows:
+                raise Exception("Invalid column '%s' length" % name)
+
+            table.columns.append(name)
+            table.data.append(column)
+        return table
@@ -25,13 +25,24 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from SocketServer import ThreadingTCPServer, ThreadingUnixStreamServer
 from BaseHTTPServer import BaseHTTPRequestHandler
-from httplib import HTTPConnection
+from httplib import HTTPConnection, HTTPException
 from urlparse import parse_qsl
+from collections import deque, OrderedDict
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from cStringIO import StringIO
+from Queue import Queue
+from gzip import GzipFile
+from inspect import getmro
+from stat import S_ISREG
 
+import threading
+import errno
+import select
 import socket
 import urllib
+import sys
+import time
 import cgi
 import re
 import os
@@ -44,8 +55,18 @@ MIME_TABLE = {
     'txt':  'text/plain',
     'htm':  'text/html',
     'html': 'text/html',
+    'json': 'application/json',
+    'svg':  'image/svg+xml',
+    'gif':  'image/gif',
+    'ico':  'image/x-icon',
 }
 
+COMPRESSIBLE_MIMES = ('application/x-javascript', 'application/json', 'image/svg+xml')
+
+RX_CONTENT_LENGTH = re.compile(r'^content-length:[ \t]*(\d+)', re.I | re.M)
+RX_CHUNKED_REQUEST = re.compile(r'^transfer-encoding:[ \t]*chunked', re.I | re.M)
+RX_EXPECT_CONTINUE = re.compile(r'^expect:[ \t]*100-continue', re.I | re.M)
+
 def _url_collapse_path(path):
     path_parts = path.split('/')
     head_parts = []
@@ -84,11 +105,316 @@ class HttpMatchRequest(object):
             return m.groups()
         return None
 
+def _libc_sendfile():
+    """
+    sendfile(2) of the libc, on linux. Python 2 has no os.sendfile().
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return None
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    func = getattr(libc, 'sendfile', None)
+    if func is None:
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+    func.restype = ctypes.c_ssize_t
+
+    def _sendfile(out_fd, in_fd, count):
+        sent = func(out_fd, in_fd, None, count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return _sendfile
+
+_sendfile = _libc_sendfile()
+
+def sendfile(sock, fd, size, timeout=None):
+    """
+    Send size bytes from the current position of the file to the socket,
+    with sendfile(2) when available, copying through a buffer otherwise.
+    """
+    if _sendfile is None:
+        while size > 0:
+            data = fd.read(min(size, 64 << 10))
+            if not data:
+                break
+            sock.sendall(data)
+            size -= len(data)
+        return
+
+    while size > 0:
+        try:
+            sent = _sendfile(sock.fileno(), fd.fileno(), min(size, 1 << 20))
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.EAGAIN:
+                raise socket.error(e.errno, e.strerror)
+            # A socket with a timeout is non-blocking
+            if not select.select([], [sock], [], timeout)[1]:
+                raise socket.timeout('timed out')
+            continue
+        if sent == 0:
+            break
+        size -= sent
+
+class StaticFile(object):
+    __slots__ = ('filename', 'mtime', 'size', 'mime', 'etag', 'last_modified', 'data', 'gzip_data')
+
+    def __init__(self, filename, stat, mime):
+        self.filename = filename
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.mime = mime
+        self.etag = '"%x-%x"' % (self.size, int(self.mtime * 1000000))
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.data = None
+        self.gzip_data = None
+
+    def load(self, compress):
+        fd = open(self.filename, 'rb')
+        try:
+            self.data = fd.read()
+        finally:
+            fd.close()
+
+        if compress:
+            buf = StringIO()
+            gz = GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+            gz.write(self.data)
+            gz.close()
+            if buf.tell() < len(self.data):
+                self.gzip_data = buf.getvalue()
+
+    def memory(self):
+        return len(self.data or '') + len(self.gzip_data or '')
+
+    def not_modified(self, headers):
+        """
+        True if the copy of the client, described by the If-None-Match or
+        If-Modified-Since request headers, is still valid.
+        """
+        etags = headers.getheader('if-none-match')
+        if etags is not None:
+            etags = [tag.strip() for tag in etags.split(',')]
+            return self.etag in etags or '*' in etags
+
+        since = headers.getheader('if-modified-since')
+        if since is not None:
+            since = parsedate_tz(since.split(';')[0])
+            if since is not None:
+                return int(self.mtime) <= mktime_tz(since)
+        return False
+
+class StaticFileCache(object):
+    """
+    Metadata of the served files, and the content of the small ones with
+    their gzip encoding. Each lookup validates the entry with a stat().
+    """
+    def __init__(self, max_file_size=256 << 10, max_memory=32 << 20):
+        self.max_file_size = max_file_size
+        self.max_memory = max_memory
+        self._files = OrderedDict()
+        self._memory = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename, mime):
+        """
+        Returns the StaticFile of filename, or None if it is not a file.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+
+        with self._lock:
+            entry = self._files.pop(filename, None)
+            if entry is not None:
+                if entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+                    # Most recently used at the end
+                    self._files[filename] = entry
+                    return entry
+                self._memory -= entry.memory()
+
+        entry = StaticFile(filename, stat, mime)
+        if stat.st_size <= self.max_file_size:
+            try:
+                entry.load(_is_compressible(mime))
+            except IOError:
+                return None
+
+        with self._lock:
+            self._files[filename] = entry
+            self._memory += entry.memory()
+            while self._memory > self.max_memory and len(self._files) > 1:
+                _, old_entry = self._files.popitem(last=False)
+                self._memory -= old_entry.memory()
+        return entry
+
+def _is_compressible(mime):
+    return mime.startswith('text/') or mime in COMPRESSIBLE_MIMES
+
+def _class_rules(cls):
+    """
+    The (rule, method name) of the @match methods of a handler class, in
+    the order they are declared in the source: the methods of the class
+    first, then those inherited from each base class.
+    """
+    rules = []
+    seen = set()
+    for klass in getmro(cls):
+        methods = []
+        for attr, value in klass.__dict__.iteritems():
+            if attr in seen:
+                continue
+            seen.add(attr)
+            if getattr(value, '_rules', None) and hasattr(value, 'func_code'):
+                methods.append((value.func_code.co_firstlineno, attr, value._rules))
+        methods.sort()
+        rules.extend((rule, attr) for _, attr, mrules in methods for rule in mrules)
+    return rules
+
+class HttpRouter(object):
+    """
+    Dispatch table of a handler class: the rules accepting a command are
+    combined in a single regex, in declaration order, so a request is
+    routed with one match instead of one per rule.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self._commands = set()
+        for rule, _ in rules:
+            self._commands.update(rule.commands or ())
+        self._tables = {}
+
+    def route(self, uri, command):
+        """
+        Returns the (method name, uri groups) of the first rule matching
+        the request, or None.
+        """
+        # Commands without a rule of their own share one table
+        if command not in self._commands:
+            command = None
+        table = self._tables.get(command)
+        if table is None:
+            table = self._tables[command] = self._compile(command)
+
+        uri_re, targets = table
+        if uri_re is None:
+            # Linear scan, the combined regex has too many groups
+            for rule, attr in targets:
+                result = rule(uri, command)
+                if result is not None:
+                    return attr, result
+            return None
+
+        m = uri_re.match(uri)
+        if m is None:
+            return None
+        attr, first, last = targets[m.lastindex]
+        return attr, m.groups()[first:last]
+
+    def _compile(self, command):
+        rules = [(rule, attr) for rule, attr in self.rules
+                 if rule.commands is None or (command and command in rule.commands)]
+        if not rules:
+            return None, rules
+
+        patterns = []
+        targets = {}
+        group = 1
+        for rule, attr in rules:
+            ngroups = rule.uri_re.groups
+            # The outer group closes last, so it is the lastindex of a match
+            targets[group] = (attr, group, group + ngroups)
+            patterns.append('(%s)' % rule.uri_re.pattern)
+            group += 1 + ngroups
+
+        try:
+            return re.compile('|'.join(patterns)), targets
+        except (AssertionError, re.error):
+            return None, rules
+
+class ChunkedWriter(object):
+    """
+    Write the body of a response as it is produced: with the chunked
+    transfer encoding for HTTP/1.1 clients, or as is (delimited by the
+    connection close) for HTTP/1.0 ones. The data is flushed to the
+    socket when the buffer is full or flush_interval seconds passed
+    since the last flush, so the first write is sent right away.
+    """
+    def __init__(self, wfile, chunked, flush_interval=0.2):
+        self.wfile = wfile
+        self.chunked = chunked
+        self.flush_interval = flush_interval
+        self._last_flush = 0
+
+    def write(self, data):
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+        now = time.time()
+        if now - self._last_flush >= self.flush_interval:
+            self.wfile.flush()
+            self._last_flush = now
+
+    def close(self):
+        if self.chunked:
+            self.wfile.write('0\r\n\r\n')
+        self.wfile.flush()
+
 class HttpRequestHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
+    # Files served by send_file()
+    static_files = StaticFileCache()
+
+    # HTTP/1.1 keeps the connection open between requests, the responses
+    # without a Content-Length (or chunked encoding) close it.
+    protocol_version = 'HTTP/1.1'
+
+    # Seconds to wait for the next request of a keep-alive connection
+    timeout = 30
+
+    # Buffer the writes, flushed at the end of each request
+    wbufsize = 64 << 10
+
+    def __init__(self, request, client_address, server, data=None):
         self.query = []
-        self._static_rules = self._fetch_static_rules()
-        BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
+        self._data = data
+        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        if self._data is not None:
+            # A single request already read by the server loop
+            self.rfile = StringIO(self._data)
+
+    def handle(self):
+        if self._data is None:
+            BaseHTTPRequestHandler.handle(self)
+        else:
+            self.close_connection = 1
+            self.handle_one_request()
+
+    def address_string(self):
+        # No reverse lookup for each logged request
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
 
     def send_headers(self, code, content_type, headers=None):
         if content_type:
@@ -96,26 +422,75 @@ class HttpRequestHandler(BaseHTTPRequestHandler):
             self.send_header('Content-Type', content_type)
         else:
             self.send_response(code, "Script output follows")
-        if headers is not None:
-            for key, value in headers.iteritems():
-                self.send_header(key, value)
+        headers = dict(headers or {})
+        names = set(key.lower() for key in headers)
+        if 'content-length' not in names and 'transfer-encoding' not in names:
+            # The end of the body is the end of the connection
+            headers['Connection'] = 'close'
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
         self.end_headers()
 
+    def send_data(self, code, content_type, data, headers=None):
+        """
+        Send a response with the whole body, keeping the connection alive.
+        """
+        headers = dict(headers or {})
+        headers['Content-Length'] = len(data)
+        self.send_headers(code, content_type, headers)
+        self.wfile.write(data)
+
+    def send_chunked_headers(self, code, content_type, headers=None):
+        """
+        Send the headers of a response streamed with the returned
+        ChunkedWriter, the connection is closed at the end.
+        """
+        chunked = (self.request_version == 'HTTP/1.1')
+        headers = dict(headers or {})
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        self.send_headers(code, content_type, headers)
+        return ChunkedWriter(self.wfile, chunked)
+
     def send_file(self, filename):
-        if os.path.exists(filename):
-            self.send_headers(200, self.guess_mime(filename))
-            fd = open(filename)
-            try:
-                while True:
-                    data = fd.read(8192)
-                    if not data:
-                        break
-                    self.wfile.write(data)
-            finally:
-                fd.close()
-        else:
+        entry = self.static_files.get(filename, self.guess_mime(filename))
+        if entry is None:
             self.log_message("File %s not found", filename)
             self.handle_not_found()
+            return
+
+        headers = {'ETag': entry.etag, 'Last-Modified': entry.last_modified}
+        if entry.not_modified(self.headers):
+            self.send_response(304)
+            for key, value in headers.iteritems():
+                self.send_header(key, value)
+            self.end_headers()
+            return
+
+        if entry.data is not None:
+            data = entry.data
+            if entry.gzip_data is not None:
+                headers['Vary'] = 'Accept-Encoding'
+                if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+                    headers['Content-Encoding'] = 'gzip'
+                    data = entry.gzip_data
+            if self.command == 'HEAD':
+                headers['Content-Length'] = len(data)
+                self.send_headers(200, entry.mime, headers)
+            else:
+                self.send_data(200, entry.mime, data, headers)
+            return
+
+        fd = open(filename, 'rb')
+        try:
+            size = os.fstat(fd.fileno()).st_size
+            headers['Content-Length'] = size
+            self.send_headers(200, entry.mime, headers)
+            if self.command != 'HEAD':
+                self.wfile.flush()
+                sendfile(self.connection, fd, size, self.timeout)
+        finally:
+            fd.close()
 
     def guess_mime(self, filename):
         _, ext = os.path.splitext(filename)
@@ -136,18 +511,21 @@ class HttpRequestHandler(BaseHTTPRequestHandler):
             self.query = []
 
         self.path = os.path.join(directory, name)
-        for match, handle_func in self._rules():
-            result = match(self.path, command)
-            if result is not None:
-                try:
-                    handle_func(*result)
-                except Exception, e:
-                    self.handle_failure(e)
-                finally:
-                    break
+        self._body_read = False
+        route = self.router().route(self.path, command)
+        if route is not None:
+            attr, args = route
+            try:
+                getattr(self, attr)(*args)
+            except Exception, e:
+                self.handle_failure(e)
         else:
             self.handle_not_found()
 
+        # The unread body would be taken as the next request
+        if not self._body_read and int(self.headers.getheader('content-length', 0) or 0) > 0:
+            self.close_connection = 1
+
     def handle_failure(self, exception):
         self.send_error(500, "Internal Server Error")
 
@@ -167,12 +545,14 @@ class HttpRequestHandler(BaseHTTPRequestHandler):
         ctype, pdict = cgi.parse_header(self.headers.typeheader or self.headers.type)
         if ctype == 'multipart/form-data':
             data = cgi.parse_multipart(self.rfile, pdict)
+            self._body_read = True
         elif ctype == 'application/x-www-form-urlencoded':
             clength = int(self.headers.getheader('content-length', 0))
             if maxlen is not None and clength > maxlen:
                 raise ValueError, 'Maximum content length exceeded'
             d = self.rfile.read(clength)
             data = parse_qsl(d)
+            self._body_read = True
         else:
             data = []
 
@@ -186,14 +566,14 @@ class HttpRequestHandler(BaseHTTPRequestHandler):
             fd.close()
         return data
 
-    def _fetch_static_rules(self):
-        return [(rule, method) for method in (getattr(self, attr)
-                               for attr in dir(self))
-                               for rule in getattr(method, "_rules", [])]
-
-    def _rules(self):
-        for rule in self._static_rules:
-            yield rule
+    @classmethod
+    def router(cls):
+        # Built once per class, on its first request
+        router = cls.__dict__.get('_router')
+        if router is None:
+            router = HttpRouter(_class_rules(cls))
+            cls._router = router
+        return router
 
     @classmethod
     def match(cls, uri_pattern, commands=None):
@@ -203,11 +583,320 @@ class HttpRequestHandler(BaseHTTPRequestHandler):
             return method
         return _wrap
 
-class TcpHttpServer(ThreadingTCPServer):
-    allow_reuse_address = True
+class _HttpConnection(object):
+    __slots__ = ('sock', 'address', 'buffer', 'last_active', 'continued')
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = ''
+        self.last_active = time.time()
+        self.continued = False
+
+class _Poller(object):
+    """
+    Readiness of the registered fds, with epoll where available
+    and select() elsewhere.
+    """
+    def __init__(self):
+        self._epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self._fds = set()
+
+    def register(self, fd):
+        if self._epoll is not None:
+            self._epoll.register(fd, select.EPOLLIN)
+        self._fds.add(fd)
 
-class UnixHttpServer(ThreadingUnixStreamServer):
+    def unregister(self, fd):
+        if fd in self._fds:
+            self._fds.discard(fd)
+            if self._epoll is not None:
+                self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            if self._epoll is not None:
+                return [fd for fd, _ in self._epoll.poll(timeout)]
+            return select.select(list(self._fds), [], [], timeout)[0]
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+
+class EventLoopHttpServer(object):
+    """
+    HTTP server with a single thread waiting on every connection and a
+    fixed pool of workers running the handlers. A request is read by the
+    loop, without holding a thread, and once complete is handed to a
+    worker; keep-alive connections go back to the loop afterwards.
+    The workers cap the requests served concurrently, the others wait
+    in the queue.
+    """
+    address_family = socket.AF_INET
     allow_reuse_address = True
+    request_queue_size = 128
+
+    # Requests served concurrently
+    max_workers = 16
+
+    # Limits of a request read by the loop
+    max_header_size = 64 << 10
+    max_body_size = 64 << 20
+
+    def __init__(self, address, request_handler):
+        self.server_address = address
+        self.RequestHandlerClass = request_handler
+        self.keep_alive_timeout = getattr(request_handler, 'timeout', None) or 30
+
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        try:
+            if self.allow_reuse_address:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(address)
+            self.server_address = self.socket.getsockname()
+            self.socket.listen(self.request_queue_size)
+            self.socket.setblocking(0)
+        except:
+            self.socket.close()
+            raise
+
+        self._connections = {}
+        self._ready = deque()
+        self._requests = Queue()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._running = False
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+        self._loop_thread = None
+        self._close_on_exit = False
+        self._closed = False
+
+        self._workers = []
+        for _ in xrange(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def serve_forever(self, poll_interval=1.0):
+        self._is_shut_down.clear()
+        self._loop_thread = threading.current_thread()
+        self._running = True
+        poller = _Poller()
+        poller.register(self.socket.fileno())
+        poller.register(self._wakeup_r)
+        self._poller = poller
+        try:
+            last_sweep = time.time()
+            while not self._shutdown_request:
+                for fd in poller.poll(poll_interval):
+                    if fd == self.socket.fileno():
+                        self._accept()
+                    elif fd == self._wakeup_r:
+                        os.read(self._wakeup_r, 4096)
+                    else:
+                        conn = self._connections.get(fd)
+                        if conn is not None:
+                            self._read(conn)
+                self._rearm_ready()
+
+                now = time.time()
+                if now - last_sweep >= poll_interval:
+                    self._close_idle(now)
+                    last_sweep = now
+        finally:
+            for fd in self._connections.keys():
+                self._close(fd)
+            poller.close()
+            self._poller = None
+            self._running = False
+            self._shutdown_request = False
+            self._loop_thread = None
+            self._is_shut_down.set()
+            if self._close_on_exit:
+                self.server_close()
+
+    def shutdown(self):
+        """
+        Stop the serve_forever() loop, waiting for it to exit unless
+        called from the loop itself (e.g. a signal handler).
+        """
+        if not self._running:
+            return
+        self._shutdown_request = True
+        self._wakeup()
+        if threading.current_thread() is not self._loop_thread:
+            self._is_shut_down.wait()
+
+    def server_close(self):
+        """
+        Stop the workers and close the listening socket. Called from the
+        loop itself (e.g. a signal handler), it is done once the loop exits.
+        """
+        if self._running and threading.current_thread() is self._loop_thread:
+            self._close_on_exit = True
+            return
+        if self._closed:
+            return
+        self._closed = True
+
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.socket.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def handle_error(self, client_address):
+        import traceback
+        traceback.print_exc()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            if self.address_family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(0)
+            conn = _HttpConnection(sock, address)
+            self._connections[sock.fileno()] = conn
+            self._poller.register(sock.fileno())
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self._close(conn.sock.fileno())
+            return
+        conn.buffer += data
+        conn.last_active = time.time()
+        self._process(conn)
+
+    def _process(self, conn):
+        head_end = conn.buffer.find('\r\n\r\n')
+        if head_end < 0:
+            if len(conn.buffer) > self.max_header_size:
+                self._reject(conn, 431, 'Request Header Fields Too Large')
+            return
+
+        head = conn.buffer[:head_end]
+        if RX_CHUNKED_REQUEST.search(head):
+            self._reject(conn, 411, 'Length Required')
+            return
+        m = RX_CONTENT_LENGTH.search(head)
+        body_size = int(m.group(1)) if m is not None else 0
+        if body_size > self.max_body_size:
+            self._reject(conn, 413, 'Request Entity Too Large')
+            return
+
+        size = head_end + 4 + body_size
+        if len(conn.buffer) < size:
+            # Clients waiting for the go ahead before sending the body
+            if not conn.continued and RX_EXPECT_CONTINUE.search(head):
+                conn.continued = True
+                self._send_raw(conn, 'HTTP/1.1 100 Continue\r\n\r\n')
+            return
+
+        request = conn.buffer[:size]
+        conn.buffer = conn.buffer[size:]
+        conn.continued = False
+        fd = conn.sock.fileno()
+        self._poller.unregister(fd)
+        del self._connections[fd]
+        self._requests.put((conn, request))
+
+    def _reject(self, conn, code, message):
+        self._send_raw(conn, 'HTTP/1.1 %d %s\r\nConnection: close\r\n'
+                             'Content-Length: 0\r\n\r\n' % (code, message))
+        self._close(conn.sock.fileno())
+
+    def _send_raw(self, conn, data):
+        try:
+            conn.sock.send(data)
+        except socket.error:
+            pass
+
+    def _close(self, fd):
+        conn = self._connections.pop(fd, None)
+        if conn is not None:
+            self._poller.unregister(fd)
+            self._close_socket(conn.sock)
+
+    def _close_socket(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+    def _close_idle(self, now):
+        for fd, conn in self._connections.items():
+            if now - conn.last_active > self.keep_alive_timeout:
+                self._close(fd)
+
+    def _rearm_ready(self):
+        while self._ready:
+            conn = self._ready.popleft()
+            if self._shutdown_request:
+                self._close_socket(conn.sock)
+                continue
+            conn.sock.setblocking(0)
+            conn.last_active = time.time()
+            fd = conn.sock.fileno()
+            self._connections[fd] = conn
+            self._poller.register(fd)
+            if conn.buffer:
+                # Pipelined request already read
+                self._process(conn)
+
+    def _worker_loop(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            conn, request = item
+            keep_alive = False
+            try:
+                conn.sock.setblocking(1)
+                handler = self.RequestHandlerClass(conn.sock, conn.address, self, request)
+                keep_alive = not handler.close_connection
+            except Exception:
+                self.handle_error(conn.address)
+
+            if keep_alive and self._running:
+                self._ready.append(conn)
+                self._wakeup()
+            else:
+                self._close_socket(conn.sock)
+
+class TcpHttpServer(EventLoopHttpServer):
+    address_family = socket.AF_INET
+
+class UnixHttpServer(EventLoopHttpServer):
+    address_family = socket.AF_UNIX
 
 class UnixHTTPConnection(HTTPConnection):
     """
@@ -222,16 +911,135 @@ class UnixHTTPConnection(HTTPConnection):
         sock.connect(self.path)
         self.sock = sock
 
-def http_open(address, path, data=None):
+def _new_connection(address):
+    if isinstance(address, basestring):
+        return UnixHTTPConnection(address)
+    return HTTPConnection(*address)
+
+def _is_alive(http):
+    """
+    An idle keep-alive connection is readable only if the server closed it.
     """
-    Wrapper around HTTPConnection and UnixHTTPConnection that allows to
-    to make a get or post http request based on data.
+    if http.sock is None:
+        return False
+    try:
+        return not select.select([http.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return False
+
+class PooledConnection(object):
+    """
+    Connection taken from an HttpConnectionPool, close() gives it back.
+    """
+    def __init__(self, pool, http, reused):
+        self.pool = pool
+        self.http = http
+        self.reused = reused
+        self.response = None
+
+    def request(self, method, path, body=None, headers=None):
+        self.http.request(method, path, body, headers or {})
+
+    def getresponse(self):
+        self.response = self.http.getresponse()
+        return self.response
+
+    def close(self):
+        if self.http is not None:
+            self.pool.release(self.http, self.response)
+            self.http = None
+
+class HttpConnectionPool(object):
+    """
+    Thread-safe pool of the keep-alive connections to an address.
+    At most max_connections are in use at the same time (the others wait),
+    the idle connections are dropped after idle_timeout seconds or when
+    the server has closed them.
+
+        http = pool.connection()
+        try:
+            http.request('GET', '/index.html')
+            response = http.getresponse()
+            response.read()
+        finally:
+            http.close()
+    """
+    def __init__(self, address, max_connections=8, idle_timeout=30):
+        self.address = address
+        self.idle_timeout = idle_timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def connection(self):
+        self._slots.acquire()
+        try:
+            http = self._pop_idle()
+            if http is not None:
+                return PooledConnection(self, http, True)
+            return PooledConnection(self, _new_connection(self.address), False)
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, http, response=None):
+        """
+        Put back the connection, if the response was read to the end
+        and the server keeps it alive.
+        """
+        try:
+            if response is None or not response.isclosed() or response.will_close:
+                http.close()
+            else:
+                with self._lock:
+                    self._idle.append((time.time(), http))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, http in idle:
+            http.close()
+
+    def _pop_idle(self):
+        expired = time.time() - self.idle_timeout
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                last_used, http = self._idle.pop()
+            if last_used >= expired and _is_alive(http):
+                return http
+            http.close()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def http_pool(address):
+    """
+    Returns the connection pool shared by the requests to the address.
+    """
+    if not isinstance(address, basestring):
+        # e.g. the [host, port] list of a json config
+        address = tuple(address)
+    with _pools_lock:
+        pool = _pools.get(address)
+        if pool is None:
+            pool = _pools[address] = HttpConnectionPool(address)
+        return pool
+
+def http_open(address, path, data=None, headers=None):
+    """
+    Make a get or post http request based on data, with a keep-alive
+    connection of the address pool (see http_pool()).
 
         address = '/var/lib/hsrv.sock'
         address = ('kernel.org', 8080)
         data = {'a': 10, 'b': 20}  # used for POST requests
+        headers = {'Accept': 'text/plain'}
 
-        http, response = http_open(address, '/index.html', data)
+        http, response = http_open(address, '/index.html', data, headers)
         try:
             response.getheader('content-type')
             response.status
@@ -239,17 +1047,26 @@ def http_open(address, path, data=None):
         finally:
             http.close()
     """
-    if isinstance(address, basestring):
-        http = UnixHTTPConnection(address)
-    else:
-        http = HTTPConnection(*address)
-
+    headers = dict(headers or {})
     if data:
-        headers = {'Content-type': 'application/x-www-form-urlencoded'}
-        http.request('POST', path, urllib.urlencode(data), headers)
+        method = 'POST'
+        body = urllib.urlencode(data)
+        headers['Content-type'] = 'application/x-www-form-urlencoded'
     else:
-        http.request('GET', path)
-    return http, http.getresponse()
+        method = 'GET'
+        body = None
+
+    pool = http_pool(address)
+    while True:
+        http = pool.connection()
+        try:
+            http.request(method, path, body, headers)
+            return http, http.getresponse()
+        except (HTTPException, socket.error):
+            http.close()
+            # The server may have closed an idle connection, retry with a new one
+            if not http.reused:
+                raise
 
 def http_readlines(address, path, data=None, chunk_size=8192):
     """
@@ -259,16 +1076,64 @@ def http_readlines(address, path, data=None, chunk_size=8192):
     """
     http, response = http_open(address, path, data)
     try:
-        data = response.read(chunk_size)
-        while data:
-            index = 0
-            while True:
-                cindex = data.find('\n', index)
-                if cindex < 0:
-                    data = data[index:]
-                    break
-                yield data[index:cindex]
-                index = cindex + 1
-            data += response.read(chunk_size)
+        for line in response_readlines(response, chunk_size):
+            yield line
     finally:
         http.close()
+
+def response_readlines(response, chunk_size=8192):
+    """
+    Read line by line the body of an Http Response.
+    """
+    data = response.read(chunk_size)
+    while data:
+        index = 0
+        while True:
+            cindex = data.find('\n', index)
+            if cindex < 0:
+                data = data[index:]
+                break
+            yield data[index:cindex]
+            index = cindex + 1
+        data += response.read(chunk_size)
+
+if __name__ == '__main__':
+    import timeit
+
+    # Dispatch cost of the aggregator and visualizer routes,
+    # matching each rule in turn against the compiled router
+    rules = [(HttpMatchRequest(uri, command), 'rule%d' % i) for i, (uri, command) in
+             enumerate([("/continuous$", 'POST'), ("/continuous/(\w+)$", 'GET'),
+                        ("/continuous/(\w+)/delta$", 'GET'), ("/continuous/(\w+)$", 'DELETE'),
+                        ("/query$", 'POST'), ('/skvoz/chart/(.+)', None), ('/(.*)', None)])]
+    router = HttpRouter(rules)
+
+    def linear(uri, command):
+        for rule, attr in rules:
+            result = rule(uri, command)
+            if result is not None:
+                return attr, result
+        return None
+
+    requests = [('/query', 'POST'), ('/continuous/abc/delta', 'GET'),
+                ('/skvoz/chart/cpu.chart', 'GET'), ('/static/skvoz.js', 'GET')]
+    for uri, command in requests:
+        assert linear(uri, command) == router.route(uri, command)
+
+    count = 200000
+    for name, func in (('linear', linear), ('router', router.route)):
+        st = timeit.default_timer()
+        for _ in xrange(count // len(requests)):
+            for uri, command in requests:
+                func(uri, command)
+        et = timeit.default_timer()
+        print '[T] %-6s %.3fusec/request' % (name, (et - st) * 1000000.0 / count)
+
+    # The rules scan, that was done on each request
+    count = 2000
+    st = timeit.default_timer()
+    for _ in xrange(count):
+        HttpRequestHandler.__dict__.pop('_router', None)
+        HttpRequestHandler.router()
+    et = timeit.default_timer()
+    print '[T] scan   %.3fusec/request' % ((et - st) * 1000000.0 / count)
@@ -87,6 +87,7 @@ class AbstractService(object):
 
             self._stopping(*args, **kwargs)
             self.server.shutdown()
+            self.server.server_close()
             if isinstance(address, basestring) and os.path.exists(address):
                 os.unlink(address)
 
@@ -95,6 +96,7 @@ class AbstractService(object):
             return
 
         self.server.shutdown()
+        self.server.server_close()
 
     def reload(self):
         pass
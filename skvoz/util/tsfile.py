@@ -30,23 +30,103 @@ from base64 import urlsafe_b64decode as name_decode
 from tempfile import mkstemp
 from gzip import GzipFile
 from bz2 import BZ2File
+from bisect import bisect_left
 from heapq import merge
 from uuid import uuid1
 
 from skvoz.util.dateutil import msec_to_timestamp
+from skvoz.util.data import string_to_type
 
 import threading
+import zlib
 import os
 import re
 
 # /key/latest        <- Currently in progress
-# /key/uid.cts       <- Currently in consolidation
+# /key/uid.tsc       <- Currently in consolidation
 # /key/uid.build     <- Currently in consolidation writing
 # /key/sts-dts-uid   <- Archived file
+# /key/sts-dts-uid.idx <- Archived file blocks index
 RX_CONSOLIDATED = re.compile('^([0-9]+\\.[0-9]+\\.[a-z0-9]+)$')
-RX_NAME = re.compile('^(latest)$|^([a-z0-9]+).cts$|^([0-9]+\\.[0-9]+\\.[a-z0-9]+)$')
+RX_NAME = re.compile('^(latest)$|^([a-z0-9]+)\\.tsc$|^([0-9]+\\.[0-9]+\\.[a-z0-9]+)$')
 
 SORT_FILE_PREFIX = 'ts_sort_'
+INDEX_SUFFIX = '.idx'
+
+# Consolidated files are a sequence of gzip members of ~BLOCK_SIZE
+# (uncompressed) each, the index keeps (first_ts, last_ts, offset, size)
+# of every block, allowing to seek directly to the requested time range.
+BLOCK_SIZE = 64 << 10
+
+# Each index entry carries also the statistics of the block: the min/max
+# number of space separated fields of the rows and the numeric min/max
+# of the first STATS_FIELDS fields, used to skip the blocks that can't
+# match the query filters.
+STATS_FIELDS = 8
+
+class BlockStats(object):
+    def __init__(self, nfields_min=None, nfields_max=None, fields=None):
+        self.nfields_min = nfields_min
+        self.nfields_max = nfields_max
+        self.fields = fields if fields is not None else []
+
+    def add(self, data):
+        nfields = data.count(' ') + 1
+        if self.nfields_min is None or nfields < self.nfields_min:
+            self.nfields_min = nfields
+        if self.nfields_max is None or nfields > self.nfields_max:
+            self.nfields_max = nfields
+
+        fields = self.fields
+        for i, value in enumerate(data.split(' ', STATS_FIELDS)[:STATS_FIELDS]):
+            if i == len(fields):
+                fields.append(None)
+            field = fields[i]
+            if field is False:
+                continue
+
+            value = string_to_type(value)
+            if isinstance(value, (basestring, bool)) or value != value:
+                fields[i] = False
+            elif field is None:
+                fields[i] = (value, value)
+            elif value < field[0]:
+                fields[i] = (value, field[1])
+            elif value > field[1]:
+                fields[i] = (field[0], value)
+
+    def field(self, index):
+        """
+        Returns the (min, max) of the field at the specified index,
+        or None if the field is not numeric in all the rows.
+        """
+        if index < len(self.fields):
+            return self.fields[index] or None
+        return None
+
+    def dumps(self):
+        fields = []
+        for field in self.fields:
+            if field:
+                fields.append('%s:%s' % tuple(_stat_str(v) for v in field))
+            else:
+                fields.append('-')
+        return ' '.join(['%d' % self.nfields_min, '%d' % self.nfields_max] + fields)
+
+    @staticmethod
+    def loads(values):
+        fields = []
+        for field in values[2:]:
+            if field == '-':
+                fields.append(False)
+            else:
+                fields.append(tuple(string_to_type(v) for v in field.split(':')))
+        return BlockStats(int(values[0]), int(values[1]), fields)
+
+def _stat_str(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
 
 def _read_raw_fd(fd):
     fd.seek(0)
@@ -67,14 +147,66 @@ def _read_raw_file(path):
         finally:
             fd.close()
 
-def _read_file(path):
+def _read_range(tslines, start=None, end=None):
+    """
+    Keep the time ordered lines with start <= timestamp <= end (msec),
+    stopping as soon as the end of the range is passed.
+    """
+    for ts, data in tslines:
+        ts = int(ts)
+        if start is not None and ts < start:
+            continue
+        if end is not None and ts > end:
+            break
+        yield msec_to_timestamp(ts), data
+
+def _read_index(path):
+    try:
+        fd = open(path + INDEX_SUFFIX)
+    except IOError:
+        return None
+    try:
+        index = []
+        for line in fd:
+            values = line.split()
+            stats = BlockStats.loads(values[4:]) if len(values) > 4 else None
+            index.append(tuple(int(x) for x in values[:4]) + (stats,))
+        return index
+    finally:
+        fd.close()
+
+def _read_blocks(path, index, start=None, end=None, block_filter=None):
+    """
+    Yields the uncompressed content of the blocks that may contain
+    rows with start <= timestamp <= end (msec).
+    block_filter(stats) returns True if the block can be skipped.
+    """
+    i = 0
+    if start is not None:
+        i = bisect_left([block[1] for block in index], start)
+
+    fd = open(path, 'rb')
+    try:
+        for first_ts, last_ts, offset, size, stats in index[i:]:
+            if end is not None and first_ts > end:
+                break
+            if block_filter is not None and stats is not None and block_filter(stats):
+                continue
+            fd.seek(offset)
+            yield zlib.decompress(fd.read(size), 16 + zlib.MAX_WBITS)
+    finally:
+        fd.close()
+
+def _read_block_lines(path, index, start=None, end=None, block_filter=None):
+    for block in _read_blocks(path, index, start, end, block_filter):
+        for line in block.splitlines():
+            yield line.split(' ', 1)
+
+def _read_content(path):
     for file_cls in (GzipFile, BZ2File, open):
         fd = file_cls(path)
         try:
-            for line in fd:
-                ts, data = line.strip().split(' ', 1)
-                yield msec_to_timestamp(int(ts)), data
-            break
+            return fd.read()
         except IOError:
             pass
         finally:
@@ -96,7 +228,7 @@ def _slice_tsfile(iterable, threshold):
         finally:
             yield chunk
 
-def sort(path, threshold, tmpdir=None):
+def _sort_raw(path, threshold, tmpdir=None):
     tmpfiles = []
 
     # Split and Sort
@@ -114,7 +246,7 @@ def sort(path, threshold, tmpdir=None):
 
         # Merge Temp Files
         for ts, data in merge(*tuple(_read_raw_fd(fd) for fd, _ in tmpfiles)):
-            yield msec_to_timestamp(int(ts)), data
+            yield ts, data
 
         for fd, fd_path in tmpfiles:
             fd.close()
@@ -123,35 +255,72 @@ def sort(path, threshold, tmpdir=None):
         tslines = list(_read_raw_file(path))
         tslines.sort()
         for ts, data in tslines:
-            yield msec_to_timestamp(int(ts)), data
+            yield ts, data
+
+def sort(path, threshold, tmpdir=None):
+    for ts, data in _sort_raw(path, threshold, tmpdir):
+        yield msec_to_timestamp(int(ts)), data
+
+def _write_block(fd, lines):
+    offset = fd.tell()
+    zfd = GzipFile(fileobj=fd, mode='wb')
+    zfd.write(''.join(lines))
+    zfd.close()
+    return offset, fd.tell() - offset
 
 def _consolidate(path, uid):
     THRESHOLD = 24 << 20
 
     dirpath, _ = os.path.split(os.path.abspath(path))
     cpath = os.path.join(dirpath, '%s.build' % uid)
-    fd = GzipFile(cpath, 'wb')
+    ipath = os.path.join(dirpath, '%s%s.build' % (uid, INDEX_SUFFIX))
+    fd = open(cpath, 'wb')
+    ifd = open(ipath, 'w')
     try:
         min_timestamp = None
         max_timestamp = None
-        for timestamp, data in sort(path, THRESHOLD, dirpath):
+        block = []
+        block_size = 0
+        block_start = None
+        block_stats = BlockStats()
+        for timestamp, data in _sort_raw(path, THRESHOLD, dirpath):
+            timestamp = int(timestamp)
             if min_timestamp is None:
                 min_timestamp = timestamp
+            if block_start is None:
+                block_start = timestamp
             max_timestamp = timestamp
-            fd.write('%s %s\n' % (timestamp, data))
+
+            line = '%d %s\n' % (timestamp, data)
+            block.append(line)
+            block_size += len(line)
+            block_stats.add(data)
+            if block_size >= BLOCK_SIZE:
+                offset, size = _write_block(fd, block)
+                ifd.write('%d %d %d %d %s\n' % (block_start, timestamp, offset, size, block_stats.dumps()))
+                block = []
+                block_size = 0
+                block_start = None
+                block_stats = BlockStats()
+
+        if block:
+            offset, size = _write_block(fd, block)
+            ifd.write('%d %d %d %d %s\n' % (block_start, max_timestamp, offset, size, block_stats.dumps()))
     except:
         fd.close()
-        try:
-            os.unlink(cpath)
-        except:
-            # TODO: USE LOG
-            print 'tsfile.consolidate(): Failed to remove %s' % cpath
+        ifd.close()
+        for p in (cpath, ipath):
+            try:
+                os.unlink(p)
+            except:
+                # TODO: USE LOG
+                print 'tsfile.consolidate(): Failed to remove %s' % p
     else:
         fd.close()
-        min_timestamp = int(min_timestamp)
-        max_timestamp = int(max_timestamp)
+        ifd.close()
         try:
             cname = '%d.%d.%s' % (min_timestamp, max_timestamp - min_timestamp, uid)
+            os.rename(ipath, os.path.join(dirpath, cname + INDEX_SUFFIX))
             os.rename(cpath, os.path.join(dirpath, cname))
             os.unlink(path)
         except:
@@ -177,39 +346,138 @@ def consolidate_sync(path):
 def is_consolidated(name):
     return RX_CONSOLIDATED.match(name) is not None
 
-def read_file(path, consolidated=False):
+def read_file(path, consolidated=False, start=None, end=None, block_filter=None):
     """
-    Read a file line by line returning the timestamp and the rest of the line:
+    Read a file line by line returning the timestamp and the rest of the line,
+    optionally only the rows with start <= timestamp <= end (msec)
+    and of the blocks not skipped by block_filter(stats):
         for ts, data in read_files(path):
             ...
     """
     if consolidated:
-        return _read_file(path)
+        index = _read_index(path)
+        if index is not None:
+            return _read_range(_read_block_lines(path, index, start, end, block_filter), start, end)
+        return _read_range(_read_raw_file(path), start, end)
 
-    data = list(_read_file(path))
+    data = [(int(ts), data) for ts, data in _read_raw_file(path)]
     data.sort()
-    return data
-
-def read_files(files, data_path=None):
+    lo = 0 if start is None else bisect_left(data, (start,))
+    hi = len(data) if end is None else bisect_left(data, (end + 1,), lo)
+    return [(msec_to_timestamp(ts), data) for ts, data in data[lo:hi]]
+
+def _file_path(f, data_path):
+    if isinstance(f, tuple):
+        path, consolidated = f
+        if data_path is not None:
+            path = os.path.join(data_path, path)
+        return path, consolidated
+    return f, False
+
+def read_files(files, data_path=None, start=None, end=None, block_filter=None):
     """
     Read all specified files and sort them by timestamp,
-    returning the timestamp and the rest of the line:
+    returning the timestamp and the rest of the line.
+    start and end (msec, inclusive) limit the rows to a time range,
+    block_filter(stats) skips the blocks that can't match the query:
         for ts, data in read_files((path0, path1, ...)):
             ...
     """
     readers = []
     for f in files:
-        if isinstance(f, tuple):
-            path, consolidated = f
-            if data_path is not None:
-                path = os.path.join(data_path, path)
-            readers.append(read_file(path, consolidated))
-        else:
-            readers.append(read_file(f))
+        path, consolidated = _file_path(f, data_path)
+        readers.append(read_file(path, consolidated, start, end, block_filter))
 
     for ts, data in merge(*readers):
         yield ts, data
 
+def read_raw_files(files, data_path=None, start=None, end=None, block_filter=None):
+    """
+    Read all specified files returning the whole unsorted content of each one.
+    For indexed files only the blocks overlapping the start/end range
+    and not skipped by block_filter(stats) are returned,
+    the caller is still responsible to filter the rows:
+        for content in read_raw_files((path0, path1, ...)):
+            ...
+    """
+    for f in files:
+        path, consolidated = _file_path(f, data_path)
+        index = _read_index(path) if consolidated else None
+        if index is not None:
+            yield ''.join(_read_blocks(path, index, start, end, block_filter))
+        else:
+            yield _read_content(path)
+
+class Tail(object):
+    """
+    Follow a file that is being appended, returning the new rows on each
+    read(). The file is kept open, so when the Writer moves 'latest' away
+    to consolidate it, the rest of the old file is read before moving to
+    the new one:
+        tail = Tail(path)
+        for ts, data in tail.read():
+            ...
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.buffer = ''
+        self.inodes = set()
+
+    def inode(self):
+        """
+        Returns the inode of the file currently at path, or None.
+        """
+        try:
+            return os.stat(self.path).st_ino
+        except OSError:
+            return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.buffer = ''
+
+    def read(self):
+        rows = []
+        while True:
+            if self.fd is None:
+                try:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                except OSError:
+                    return rows
+                self.inodes.add(os.fstat(self.fd).st_ino)
+
+            self._read_rows(rows)
+            inode = self.inode()
+            if inode == os.fstat(self.fd).st_ino:
+                return rows
+
+            # The file was moved away, read the rows written before the move
+            self._read_rows(rows)
+            self.close()
+            if inode is None:
+                return rows
+
+    def _read_rows(self, rows):
+        chunks = []
+        while True:
+            chunk = os.read(self.fd, 1 << 20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        if not chunks:
+            return
+
+        lines = (self.buffer + ''.join(chunks)).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                ts, data = line.split(' ', 1)
+                rows.append((msec_to_timestamp(int(ts)), data))
+
 def read(data_path, key):
     return read_files(data_path, find_files(data_path, key))
 
@@ -224,14 +492,21 @@ def find_files(data_path, key):
         if r is not None:
             yield os.path.join(key, name), r.groups()[2] is not None
 
+def segment_range(name):
+    """
+    Returns the (start, end) timestamps (msec) of a consolidated file.
+    """
+    st, dt, _ = os.path.basename(name).split('.')
+    st = int(st)
+    return st, st + int(dt)
+
 def filter_files_by_time(files, start_time, end_time):
     for name, consolidated in files:
         if consolidated:
-            st, dt, uid = name.split('.')
-            st = int(st)
-            dt = int(dt)
-            et = st + dt
-            if start_time > et or end_time < st:
+            st, et = segment_range(name)
+            if start_time is not None and start_time > et:
+                continue
+            if end_time is not None and end_time < st:
                 continue
         yield name, consolidated
 
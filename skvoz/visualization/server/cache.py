@@ -25,6 +25,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from threading import Lock, RLock, Event
 from time import time
 import zlib
 
@@ -39,13 +40,15 @@ class CacheStore(object):
             cls.__instance = super(CacheStore, cls).__new__(cls)
             cls.data = {}
             cls.size = 0
+            cls.lock = RLock()
         return cls.__instance
 
     def get(self, key):
-        timestamp, value = self.data.get(key, self.NULL_ITEM)
-        if time() > timestamp:
-            self.flush()
-            raise KeyError
+        with self.lock:
+            timestamp, value = self.data.get(key, self.NULL_ITEM)
+            if time() > timestamp:
+                self.flush()
+                raise KeyError
 
         if isinstance(value, basestring):
             return zlib.decompress(value)
@@ -54,39 +57,48 @@ class CacheStore(object):
     def add(self, key, value, expire):
         if isinstance(value, basestring):
             value = zlib.compress(value)
-            self.size += len(value)
-        self.flush()
-        self.data[key] = (time() + expire, value)
+        with self.lock:
+            _, old_value = self.data.pop(key, self.NULL_ITEM)
+            if isinstance(old_value, basestring):
+                self.size -= len(old_value)
+            if isinstance(value, basestring):
+                self.size += len(value)
+            self.flush()
+            self.data[key] = (time() + expire, value)
 
     def flush(self):
-        if self.size <= self.MAX_CACHE_SIZE:
-            return
-
-        sdata = self._sort_by_timestamp()
-        removed = 0
-
-        now = time()
-        for key, (timestamp, value) in sdata:
-            if now >= timestamp:
-                self.size -= len(value)
-                del self.data[key]
-                removed += 1
-            else:
-                break
-
-        if self.size > self.MAX_CACHE_SIZE:
-            for i in xrange(removed, len(sdata)):
-                if self.size > self.MAX_CACHE_SIZE:
-                    del self.data[sdata[i][0]]
+        with self.lock:
+            if self.size <= self.MAX_CACHE_SIZE:
+                return
+
+            sdata = self._sort_by_timestamp()
+            removed = 0
+
+            now = time()
+            for key, (timestamp, value) in sdata:
+                if now >= timestamp:
+                    self.size -= len(value)
+                    del self.data[key]
                     removed += 1
                 else:
                     break
 
-        return removed
+            if self.size > self.MAX_CACHE_SIZE:
+                for i in xrange(removed, len(sdata)):
+                    if self.size > self.MAX_CACHE_SIZE:
+                        key, (timestamp, value) = sdata[i]
+                        self.size -= len(value)
+                        del self.data[key]
+                        removed += 1
+                    else:
+                        break
+
+            return removed
 
     def clear(self):
-        self.data.clear()
-        self.size = 0
+        with self.lock:
+            self.data.clear()
+            self.size = 0
 
     def _sort_by_timestamp(self):
         return sorted(self.data.iteritems(), key=lambda x: x[1][0])
@@ -100,9 +112,49 @@ class CacheStore(object):
                 try:
                     value = cache.get(ckey)
                 except KeyError:
-                    print ckey, 'not in cache'
                     value = func(*args, **kwargs)
                     cache.add(ckey, value, expire)
                 return value
             return _fwrap
         return _fcache
+
+class _Flight(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Coalesce the concurrent calls with the same key: the first one runs
+    the function, the others wait for it and share its result.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = func(*args, **kwargs)
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
@@ -52,6 +52,9 @@ def execute(path, rfile, wfile, args=[], env={}):
     # Values must be string
     for k, v in env.iteritems(): env[k] = str(v)
 
+    # The request read in memory by the server has no descriptor
+    rfd = rfile.fileno() if hasattr(rfile, 'fileno') else None
+
     nobody = nobody_uid()
     wfile.flush() # Always flush before forking
     pid = os.fork()
@@ -59,7 +62,7 @@ def execute(path, rfile, wfile, args=[], env={}):
         # Parent
         pid, sts = os.waitpid(pid, 0)
         # throw away additional data [see bug #427345]
-        while select.select([rfile], [], [], 0)[0]:
+        while rfd is not None and select.select([rfile], [], [], 0)[0]:
             if not rfile.read(1):
                 break
         return sts
@@ -71,7 +74,7 @@ def execute(path, rfile, wfile, args=[], env={}):
         except os.error:
             pass
         fdnull = open(os.devnull, 'a+')
-        os.dup2(rfile.fileno(), 0)
+        os.dup2(rfd if rfd is not None else fdnull.fileno(), 0)
         os.dup2(wfile.fileno(), 1)
         if not __debug__:
             os.dup2(fdnull.fileno(), 2)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2012, Matteo Bertozzi
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the <organization> nor the
+#     names of its contributors may be used to endorse or promote products
+#     derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from hashlib import md5
+
+import threading
+import imp
+import os
+import re
+
+RX_RENDER_FUNC = re.compile('^def render\\(', re.M)
+
+DEFAULT_CONTENT_TYPE = 'text/html'
+
+class _PageEntry(object):
+    __slots__ = ('mtime', 'module')
+
+    def __init__(self, mtime, module):
+        self.mtime = mtime
+        self.module = module
+
+class PageHandlers(object):
+    """
+    Pages rendered in-process: an executable page script that defines a
+    top-level render(query_vars) function is imported once, and again
+    when its mtime changes, instead of running as a CGI on each hit.
+    The page code runs with the privileges of the server, not as nobody
+    like the CGIs, so this is enabled only for trusted pages directories.
+    """
+    def __init__(self):
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns the module of the page with its render() function, or None
+        if the page must be executed as a CGI.
+        """
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        entry = self._pages.get(path)
+        if entry is not None and entry.mtime == mtime:
+            return entry.module
+
+        with self._lock:
+            entry = self._pages.get(path)
+            if entry is None or entry.mtime != mtime:
+                entry = _PageEntry(mtime, self._load(path))
+                self._pages[path] = entry
+        return entry.module
+
+    def _load(self, path):
+        fd = open(path)
+        try:
+            source = fd.read()
+        finally:
+            fd.close()
+
+        # Scripts without render() may write the page at import time
+        if not RX_RENDER_FUNC.search(source):
+            return None
+
+        # Compiled from the source, without writing a .pyc in the pages dir
+        module = imp.new_module('skvoz_page_%s' % md5(path).hexdigest())
+        module.__file__ = path
+        exec compile(source, path, 'exec') in module.__dict__
+        return module
+
+def render(module, query_vars):
+    """
+    Returns the (content type, body) of the page.
+    """
+    body = module.render(query_vars)
+    if not isinstance(body, basestring):
+        body = ''.join(body)
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    return getattr(module, 'CONTENT_TYPE', DEFAULT_CONTENT_TYPE), body
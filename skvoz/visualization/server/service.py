@@ -26,55 +26,100 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from skvoz.visualization.server import charts
+from skvoz.visualization.server.cache import CacheStore, SingleFlight
+from skvoz.visualization.server import pages
 from skvoz.visualization.server import cgi
 
 from skvoz.util.http import HttpRequestHandler, UnixHttpServer, TcpHttpServer
 from skvoz.util.service import AbstractService
-from skvoz.util.http import http_readlines
-from skvoz.util.data import DataTable
+from skvoz.util.http import http_open, response_readlines
+from skvoz.util.data import DataTable, COLUMNS_MIME, flatten_result
 
 from json import loads as json_loads
 from base64 import b64encode
 
 import skvoz
 
+import time
 import os
 import re
 
+RX_INDEX_FILE = re.compile('^index(\\..+|)$')
+
 def fetch_data_table(address, query):
-    table = DataTable()
-    for line in http_readlines(address, '/query', {'query': b64encode(query)}):
-        data = json_loads(line)
-
-        if not isinstance(data, dict):
-            _data = {}
-            keys, gdata = data
-            if '__ts__' in keys:
-                _data['__ts__'] = keys.pop('__ts__')
-            keys = ''.join(keys)
-            for kdata in gdata:
-                for k, v in kdata.iteritems():
-                    _data['%s%s' % (keys, k)] = v
-            data = _data
-
-        data.pop('__key__', None)
-        print data
-        table.addRow(data)
-    return table
+    """
+    Run the query on the aggregator, asking for the binary columnar
+    format, and falling back to the NDJSON rows for older aggregators.
+    """
+    data = {'query': b64encode(query)}
+    http, response = http_open(address, '/query', data, {'Accept': COLUMNS_MIME})
+    try:
+        if response.getheader('content-type') == COLUMNS_MIME:
+            return DataTable.fromBinary(response.read())
+
+        table = DataTable()
+        for line in response_readlines(response):
+            table.addRow(flatten_result(json_loads(line)))
+        return table
+    finally:
+        http.close()
+
+# Seconds a chart is cached, unless its config has a "cache_ttl"
+DEFAULT_CHART_TTL = 5
+
+_chart_configs = {}
+_chart_flights = SingleFlight()
+
+def _load_config(path):
+    # Read again only when the file changes
+    mtime = os.path.getmtime(path)
+    cached = _chart_configs.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached
 
-def _load_and_replace_vars(path, query_vars):
     fd = file(path)
     try:
-        data = fd.read()
-        for key, value in query_vars:
-            data = data.replace('${%s}' % key, value)
-        return data
+        cached = (mtime, fd.read())
     finally:
         fd.close()
+    _chart_configs[path] = cached
+    return cached
+
+def _load_and_replace_vars(path, query_vars):
+    mtime, data = _load_config(path)
+    for key, value in query_vars:
+        data = data.replace('${%s}' % key, value)
+    return mtime, data
 
 def chart_from_config(path, query_vars):
-    conf = json_loads(_load_and_replace_vars(path, query_vars))
+    """
+    Returns the chart of the graph config, cached on the config mtime and
+    the substituted vars. The concurrent requests of a chart not in cache
+    wait for a single aggregator query.
+    """
+    mtime, data = _load_and_replace_vars(path, query_vars)
+    key = ('chart', path, mtime, data)
+    try:
+        return CacheStore().get(key)
+    except KeyError:
+        return _chart_flights.do(key, _cached_chart, key, data)
+
+def _cached_chart(key, data):
+    cache = CacheStore()
+    try:
+        # Added by a flight ended while this one was starting
+        return cache.get(key)
+    except KeyError:
+        pass
 
+    conf = json_loads(data)
+    json_chart = _render_chart(conf)
+    expire = conf.get('cache_ttl', DEFAULT_CHART_TTL)
+    if expire > 0:
+        cache.add(key, json_chart, expire)
+    return json_chart
+
+def _render_chart(conf):
     table = fetch_data_table(conf['aggregator'], conf['query'])
 
     chart_renderer = conf.get('renderer')
@@ -96,16 +141,23 @@ def chart_from_config(path, query_vars):
     return '{"name": "%s", "type": "%s", "chart": %s}' % (chart.name, chart_renderer.NAME, chart.toData())
 
 class VisualizatorRequestHandler(HttpRequestHandler):
-    RAW_FILE_EXT = ('htm', 'html', 'css' 'js', 'txt', 'png', 'jpg')
+    RAW_FILE_EXT = ('htm', 'html', 'css', 'js', 'txt', 'png', 'jpg')
     INDEX_EXT = ('htm', 'html', 'py', 'txt')
 
+    # Resolved page paths, looked up again after PATH_CACHE_TTL seconds
+    PATH_CACHE_TTL = 2.0
+    PATH_CACHE_SIZE = 4096
+    _paths = {}
+
+    # Executable pages with a render() function, run in-process
+    page_handlers = pages.PageHandlers()
+
     @HttpRequestHandler.match('/skvoz/chart/(.+)')
     def graph(self, name):
         path = os.path.join(self.server.graphs_dir, name)
         if os.path.exists(path):
             json_chart = chart_from_config(path, self.query)
-            self.send_headers(200, 'text/plain')
-            self.wfile.write(json_chart)
+            self.send_data(200, 'text/plain', json_chart)
         else:
             self.handle_not_found()
 
@@ -118,6 +170,19 @@ class VisualizatorRequestHandler(HttpRequestHandler):
             self._load_page(path)
 
     def _find_path(self, name):
+        key = (self.server.pages_dir, name)
+        now = time.time()
+        cached = self._paths.get(key)
+        if cached is not None and now - cached[0] < self.PATH_CACHE_TTL:
+            return cached[1]
+
+        path = self._resolve_path(name)
+        if len(self._paths) >= self.PATH_CACHE_SIZE:
+            self._paths.clear()
+        self._paths[key] = (now, path)
+        return path
+
+    def _resolve_path(self, name):
         path = os.path.join(self.server.pages_dir, name)
         if os.path.exists(path):
             rpath = self._find_file(path, True)
@@ -134,9 +199,8 @@ class VisualizatorRequestHandler(HttpRequestHandler):
             # Search for 'index*' file
             names = []
             nprio = len(self.INDEX_EXT)
-            rx = re.compile('^index(\\..+|)$')
             for f in os.listdir(path):
-                if not rx.match(f):
+                if not RX_INDEX_FILE.match(f):
                     continue
 
                 _, ext = os.path.splitext(f)
@@ -165,6 +229,16 @@ class VisualizatorRequestHandler(HttpRequestHandler):
         _, ext = os.path.splitext(path)
         if ext[1:] in self.RAW_FILE_EXT or not cgi.is_executable(path):
             self.send_file(path)
+            return
+
+        # In-process pages run with the server privileges, CGIs as nobody
+        page = None
+        if self.server.inprocess_pages:
+            page = self.page_handlers.get(path)
+        if page is not None:
+            env = dict(self._post_data() + self.query)
+            content_type, body = pages.render(page, env)
+            self.send_data(200, content_type, body)
         else:
             self.send_headers(200, None)
             try:
@@ -175,13 +249,17 @@ class VisualizatorRequestHandler(HttpRequestHandler):
 
 
 class VisualizatorUnixServer(UnixHttpServer):
-    def __init__(self, address, request_handler, pages_dir, graphs_dir):
+    def __init__(self, address, request_handler, pages_dir, graphs_dir,
+                 inprocess_pages=False):
+        self.inprocess_pages = inprocess_pages
         self.graphs_dir = graphs_dir
         self.pages_dir = pages_dir
         UnixHttpServer.__init__(self, address, request_handler)
 
 class VisualizatorTcpServer(TcpHttpServer):
-    def __init__(self, address, request_handler, pages_dir, graphs_dir):
+    def __init__(self, address, request_handler, pages_dir, graphs_dir,
+                 inprocess_pages=False):
+        self.inprocess_pages = inprocess_pages
         self.graphs_dir = graphs_dir
         self.pages_dir = pages_dir
         TcpHttpServer.__init__(self, address, request_handler)